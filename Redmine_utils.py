@@ -1,71 +1,1331 @@
 # -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import calendar
+import copy
+import datetime
+import email.utils
+import json
+import numpy as np
+from operator import attrgetter
+import os
+import random
+import sqlite3
+import threading
+import time
+import urllib.parse
 import requests
+from requests.adapters import HTTPAdapter
 import yaml
 import pdb
 from pprint import pprint
 import sys
+from sys import intern
 
-class Redmine_utils:
+# aiohttp is optional, without it the async engine runs the requests of the shared session in threads
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+
+class Metadata_cache:
+    """
+    A local SQLite cache of slowly changing Redmine metadata, like projects, users, groups and activities.
+    """
+
+    # hours a cached resource is used before it is checked against Redmine again
+    default_ttl = {
+        'projects'  : 24,
+        'users'     : 24,
+        'groups'    : 24,
+        'activities': 24*7,
+    }
+
+
+
+    def __init__(self, path, url, ttl=None, refresh=False, offline=False):
+        """
+        Open (or create) the cache database.
+
+        Args:
+            path: Path to the SQLite file.
+            url: Redmine URL, so that caches of different Redmine instances don't mix.
+            ttl: Dict of hours to trust each resource, overriding default_ttl.
+            refresh: Download all metadata again, ignoring the cache.
+            offline: Only use the cache, never download metadata.
+        """
+
+        self.url     = url
+        self.ttl     = dict(self.default_ttl, **(ttl or {}))
+        self.refresh = refresh
+        self.offline = offline
+
+        # the cache can be used from the fetching threads as well
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db   = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                                   url         TEXT,
+                                   resource    TEXT,
+                                   fetched_at  REAL,
+                                   updated_on  TEXT,
+                                   total_count INTEGER,
+                                   data        TEXT,
+                                   PRIMARY KEY (url, resource))""")
+
+
+
+    def load(self, resource):
+        """
+        Return the cached row of a resource as a dict, or None if it is not cached.
+        """
+
+        with self.lock:
+            row = self.db.execute("SELECT fetched_at, updated_on, total_count, data FROM metadata WHERE url=? AND resource=?", (self.url, resource)).fetchone()
+
+        if row is None:
+            return None
+
+        return {'fetched_at': row[0], 'updated_on': row[1], 'total_count': row[2], 'data': json.loads(row[3])}
+
+
+
+    def save(self, resource, data):
+        """
+        Store the data of a resource, noting the newest updated_on of its items if they have one.
+        """
+
+        updated_on  = None
+        total_count = None
+        if isinstance(data, list):
+            total_count = len(data)
+            updated_on  = max((item['updated_on'] for item in data if item.get('updated_on')), default=None)
+
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)", (self.url, resource, time.time(), updated_on, total_count, json.dumps(data)))
+
+
+
+    def touch(self, resource):
+        """
+        Mark a cached resource as just checked.
+        """
+
+        with self.lock, self.db:
+            self.db.execute("UPDATE metadata SET fetched_at=? WHERE url=? AND resource=?", (time.time(), self.url, resource))
+
+
+
+    def get(self, resource, fetch, is_unchanged=None):
+        """
+        Return the data of a resource, from the cache if it is still valid, otherwise from fetch().
+
+        Args:
+            resource: Name of the resource, e.g. 'users' or 'groups/12'.
+            fetch: Function that downloads the data.
+            is_unchanged: Function that gets the cached row when the ttl has run out, and returns True
+                          if Redmine has nothing newer. Used for resources that have updated_on.
+        """
+
+        cached = self.load(resource)
+
+        # never download anything when offline
+        if self.offline:
+            if cached is None:
+                sys.exit(f"ERROR: --offline specified, but there is no cached copy of the Redmine {resource}.")
+            return cached['data']
+
+        if cached is not None and not self.refresh:
+
+            # still fresh
+            ttl = self.ttl.get(resource.split('/')[0], 24)
+            if time.time() - cached['fetched_at'] < ttl * 3600:
+                return cached['data']
+
+            # old, but nothing has changed in Redmine
+            if is_unchanged and cached['updated_on'] and is_unchanged(cached):
+                self.touch(resource)
+                return cached['data']
+
+        data = fetch()
+        self.save(resource, data)
+        return data
+
+
+
+class Time_entry_store:
+    """
+    A local SQLite copy of the Redmine time entries, kept up to date with small delta requests.
+    """
+
+    def __init__(self, path, url, reconcile_days=7):
+        """
+        Open (or create) the store database.
+
+        Args:
+            path: Path to the SQLite file.
+            url: Redmine URL, so that entries of different Redmine instances don't mix.
+            reconcile_days: Days between checks for time entries deleted in Redmine.
+        """
+
+        self.url            = url
+        self.reconcile_days = reconcile_days
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db   = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS time_entries (
+                                   url         TEXT,
+                                   id          INTEGER,
+                                   spent_on    TEXT,
+                                   project_id  INTEGER,
+                                   issue_id    INTEGER,
+                                   user_id     INTEGER,
+                                   activity_id INTEGER,
+                                   hours       REAL,
+                                   updated_on  TEXT,
+                                   data        TEXT,
+                                   PRIMARY KEY (url, id))""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS time_entries_spent_on ON time_entries (url, spent_on)")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS sync_state (
+                                   url           TEXT PRIMARY KEY,
+                                   synced_at     TEXT,
+                                   reconciled_at REAL)""")
+
+
+
+    def upsert(self, time_entries):
+        """
+        Insert or update time entries, as returned by the Redmine API.
+        """
+
+        rows = [ (self.url, entry['id'], entry['spent_on'], entry['project']['id'], entry.get('issue', {}).get('id'),
+                  entry['user']['id'], entry['activity']['id'], entry['hours'], entry.get('updated_on'), json.dumps(entry))
+                 for entry in time_entries ]
+
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO time_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+
+    def sync(self, session):
+        """
+        Bring the store up to date with Redmine.
+
+        The first sync downloads all time entries, later syncs only the ones updated since the last sync.
+        They are fetched one month at a time with a stable sort, see Async_redmine.get_time_entries.
+        Every reconcile_days the number of entries per month is compared with Redmine, and months that
+        differ (e.g. because entries were deleted) are downloaded again.
+        """
+
+        with self.lock:
+            state = self.db.execute("SELECT synced_at, reconciled_at FROM sync_state WHERE url=?", (self.url,)).fetchone()
+
+        # note the time before fetching, with some margin for clock differences
+        sync_start = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - 600))
+
+        if state is None:
+            print('Time entry store is empty, downloading all time entries.')
+            params        = {}
+            reconciled_at = time.time()
+        else:
+            params        = {'updated_on': f'>={state[0]}'}
+            reconciled_at = state[1]
+
+        async def fetch(redmine, start_date, end_date):
+            n_entries = 0
+            async for data in redmine.get_time_entries(start_date, end_date, params):
+                self.upsert(data['time_entries'])
+                n_entries += len(data['time_entries'])
+                print(f'Syncing time entries: {n_entries} of {data["total_count"]}           ', end='\r')
+            return n_entries
+
+        # the months to fetch, entries spent outside them while syncing are picked up by the next sync
+        span      = self.remote_span(session, params)
+        n_entries = run_async(session, fetch, *span) if span else 0
+        print(f'Syncing time entries: {n_entries} new or updated                  ')
+
+        # look for deleted time entries now and then
+        if time.time() - reconciled_at > self.reconcile_days * 86400:
+            self.reconcile(session)
+            reconciled_at = time.time()
+
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)", (self.url, sync_start, reconciled_at))
+
+
+
+    def remote_span(self, session, params):
+        """
+        Return the first and last spent_on of the time entries in Redmine matching the params, None if there are none.
+        """
+
+        oldest = session.get_json('time_entries.json', dict(params, limit=1, sort='spent_on'))['time_entries']
+        if not oldest:
+            return None
+
+        newest = session.get_json('time_entries.json', dict(params, limit=1, sort='spent_on:desc'))['time_entries']
+        return oldest[0]['spent_on'], (newest or oldest)[0]['spent_on']
+
+
+
+    def reconcile(self, session):
+        """
+        Download again all months where the number of time entries differs from Redmine.
+        """
+
+        with self.lock:
+            local_counts = dict(self.db.execute("SELECT substr(spent_on, 1, 7), count(*) FROM time_entries WHERE url=? GROUP BY 1", (self.url,)).fetchall())
+
+        def month_range(month):
+            year, month_num = map(int, month.split('-'))
+            return f'{month}-01', f'{month}-{calendar.monthrange(year, month_num)[1]:02d}'
+
+        def remote_count(month):
+            first, last = month_range(month)
+            return month, session.get_json('time_entries.json', {'spent_on': f'><{first}|{last}', 'limit': 1})['total_count']
+
+        with ThreadPoolExecutor(max_workers=session.workers) as executor:
+            changed_months = [ month for month, count in executor.map(remote_count, local_counts) if count != local_counts[month] ]
+
+        async def fetch_month(redmine, month):
+            time_entries = []
+            async for data in redmine.get_time_entries(*month_range(month)):
+                time_entries.extend(data['time_entries'])
+            return time_entries
+
+        async def fetch_months(redmine):
+            return await asyncio.gather(*[ fetch_month(redmine, month) for month in changed_months ])
+
+        for month in changed_months:
+            print(f'Time entries of {month} differ from Redmine, downloading them again.')
+
+        for month, time_entries in zip(changed_months, run_async(session, fetch_months)):
+            first, last = month_range(month)
+            with self.lock, self.db:
+                self.db.execute("DELETE FROM time_entries WHERE url=? AND spent_on BETWEEN ? AND ?", (self.url, first, last))
+            self.upsert(time_entries)
+
+
+
+    def query(self, start_date, end_date, project_ids=None, user_ids=None, activity_ids=None):
+        """
+        Return the stored time entries spent between two dates (inclusive), optionally only
+        for the given projects, users and activities, as dicts like the ones from the Redmine API.
+        They are sorted like Redmine sorts them by default, newest spent_on first and, within a day, the newest
+        entry first. Redmine sorts a day on created_on, the id is used here as it increases with created_on.
+        """
+
+        sql    = "SELECT data FROM time_entries WHERE url=? AND spent_on BETWEEN ? AND ?"
+        values = [self.url, start_date, end_date]
+
+        for column, ids in [('project_id', project_ids), ('user_id', user_ids), ('activity_id', activity_ids)]:
+            if ids is not None:
+                ids     = list(ids)
+                sql    += f" AND {column} IN ({','.join('?' * len(ids))})"
+                values += ids
+
+        with self.lock:
+            rows = self.db.execute(sql + " ORDER BY spent_on DESC, id DESC", values).fetchall()
+
+        return [ json.loads(row[0]) for row in rows ]
+
+
+
+class Time_entry_batch:
+    """
+    Time entries decoded into columns, NumPy arrays with one element per entry, so they can be summed with vectorized group-bys.
+
+    Entries without an issue have issue id -1. Activity names are interned as codes, indexes into activity_names,
+    and the project and user names are kept once per id.
+    """
+
+    def __init__(self, time_entries):
+        """
+        Decode a list of Time_entry records.
+        """
+
+        n = len(time_entries)
+
+        # one array per field, filled straight from the records
+        def column(field, dtype=np.int64):
+            return np.fromiter(map(attrgetter(field), time_entries), dtype=dtype, count=n)
+
+        self.ids          = column('id')
+        self.hours        = column('hours', np.float64)
+        self.issue_ids    = np.fromiter(( -1 if issue_id is None else issue_id for issue_id in map(attrgetter('issue_id'), time_entries) ), dtype=np.int64, count=n)
+        self.project_ids  = column('project_id')
+        self.user_ids     = column('user_id')
+        self.activity_ids = column('activity_id')
+
+        # intern the activity names, numbered in the order they first occur
+        activity_codes      = {}
+        self.activity_codes = np.fromiter(( activity_codes.setdefault(entry.activity_name, len(activity_codes)) for entry in time_entries ), dtype=np.int64, count=n)
+        self.activity_names = list(activity_codes)
+
+        # the first name seen for each id, going backwards lets the first one overwrite the later ones
+        self.project_names = { entry.project_id: entry.project_name for entry in reversed(time_entries) }
+        self.user_names    = { entry.user_id: entry.user_name for entry in reversed(time_entries) }
+
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+
+    def group(self, columns, mask=None):
+        """
+        Group the entries selected by mask by the combination of values in columns.
+
+        Returns the keys, tuples of column values in the order they first occur, and for each selected entry the index of its key.
+        """
+
+        if mask is None:
+            mask = np.ones(len(self), dtype=bool)
+
+        columns = [ np.asarray(column)[mask] for column in columns ]
+        if len(columns[0]) == 0:
+            return [], np.zeros(0, dtype=np.intp)
+
+        # fold the columns into a single int64 key, like np.ravel_multi_index. A column is used as its offset from
+        # its smallest value, unless it spans too many values, in which case it is numbered by sorting it instead
+        key  = np.zeros(len(columns[0]), dtype=np.int64)
+        size = 1
+        for column in columns:
+            low  = int(column.min())
+            span = int(column.max()) - low + 1
+            if span <= 4 * len(column):
+                codes = column.astype(np.int64) - low
+            else:
+                values, codes = np.unique(column, return_inverse=True)
+                codes, span = codes.ravel(), len(values)
+
+            # make the key compact again before it could overflow
+            if size * span >= 2**62:
+                key  = np.unique(key, return_inverse=True)[1].ravel()
+                size = int(key.max()) + 1
+
+            key   = key * span + codes
+            size *= span
+
+        # number the keys that occur, in the order of their values. Without sorting if the key range is small,
+        # which it usually is, otherwise with np.unique
+        if size <= 4 * len(key):
+            codes  = np.cumsum(np.bincount(key, minlength=size) > 0) - 1
+            key    = codes[key]
+            n_keys = int(codes[-1]) + 1
+        else:
+            key    = np.unique(key, return_inverse=True)[1].ravel()
+            n_keys = int(key.max()) + 1
+
+        # renumber the keys in the order they first occur
+        first = np.full(n_keys, len(key), dtype=np.int64)
+        np.minimum.at(first, key, np.arange(len(key)))
+        order       = np.argsort(first)
+        rank        = np.empty_like(order)
+        rank[order] = np.arange(n_keys)
+
+        # read the column values of each key from its first entry
+        first_entries = first[order]
+        keys = list(zip(*[ column[first_entries].tolist() for column in columns ]))
+
+        return keys, rank[key]
+
+
+
+    def sum_hours(self, columns, mask=None):
+        """
+        Sum the hours of the entries selected by mask per combination of values in columns.
+
+        Returns a dict of the sums, by key tuple, in the order the keys first occur.
+        The hours are added up in entry order, giving the same sums as adding them one by one.
+        """
+
+        keys, inverse = self.group(columns, mask)
+        hours = self.hours if mask is None else self.hours[mask]
+        sums  = np.bincount(inverse, weights=hours, minlength=len(keys))
+
+        return dict(zip(keys, sums.tolist()))
+
+
+
+def add_cache_arguments(parser, time_entries=True):
+    """
+    Add the local cache and store options shared by all scripts to an argument parser.
+    The --store option is only added for scripts that use time entries.
+    """
+
+    parser.add_argument('--refresh', help='Download projects, users, groups and activities from Redmine again, ignoring the local cache.', action='store_true')
+    parser.add_argument('--offline', help='Only use the locally cached projects, users, groups and activities, never download them. With --store, the stored time entries are used without syncing.', action='store_true')
+    if time_entries:
+        parser.add_argument('--store',   help='Keep a local copy of all time entries, only download the ones changed since the last run, and read the time entries from it.', action='store_true')
+
+
+
+class Rate_limiter:
+    """
+    A token bucket limiting the number of requests per second sent to Redmine, shared by all threads.
+
+    Tokens are added at rate per second, up to burst, and each request takes one. A request that
+    finds the bucket empty reserves the next token and is told how long to wait for it.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Allow rate requests per second on average, and bursts of up to burst requests (rate by default).
+        A rate of None or 0 doesn't limit the requests at all.
+        """
+
+        if rate is not None and (not isinstance(rate, (int, float)) or rate < 0):
+            sys.exit(f"ERROR: rate_limit must be a number of requests per second, or 0 for no limit, not {rate!r}.")
+        if burst is not None and (not isinstance(burst, (int, float)) or burst < 1):
+            sys.exit(f"ERROR: rate_burst must be a number of requests of at least 1, not {burst!r}.")
+
+        self.rate    = rate or None
+        self.burst   = burst or max(self.rate or 1, 1)
+        self.tokens  = self.burst
+        self.updated = time.monotonic()
+        self.lock    = threading.Lock()
+
+
+
+    def reserve(self):
+        """
+        Take a token, and return the number of seconds to wait before sending the request.
+        """
+
+        if self.rate is None:
+            return 0
+
+        with self.lock:
+            now          = time.monotonic()
+            self.tokens  = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # the bucket can go below zero, the requests then wait in line for the tokens they took
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+
+
+    def wait(self):
+        """
+        Block until a token is available.
+        """
+
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+
+class Concurrency_controller:
+    """
+    Limits the number of requests in flight to Redmine, adapting the limit to how the server copes.
+
+    The limit is halved when Redmine answers 429 or 5xx, fails to answer, or gets much slower than
+    usual, and grows by one for every limit fast answers, up to max_limit (additive increase,
+    multiplicative decrease). What is usual is tracked per kind of request, as a limit=1 count is
+    much faster than a full page of time entries. Shared by all threads, and by the async engine
+    through try_acquire and add_listener.
+    """
+
+    def __init__(self, max_limit, min_limit=1, slow_factor=2.0, fast_latency=0.2):
+        """
+        Start at max_limit requests at a time, never going below min_limit.
+
+        Args:
+            max_limit: Most requests in flight at once.
+            min_limit: Fewest requests in flight at once, even when Redmine struggles.
+            slow_factor: An answer counts as slow if it takes this many times longer than the fastest usual answers of its kind.
+            fast_latency: Seconds within which an answer never counts as slow, so that jitter in very fast answers is ignored.
+        """
+
+        self.max_limit    = max_limit
+        self.min_limit    = min(min_limit, max_limit)
+        self.slow_factor  = slow_factor
+        self.fast_latency = fast_latency
+        self.limit        = max_limit
+        self.in_flight    = 0
+        self.successes    = 0
+        self.answers      = 0
+        self.latencies    = {}
+        self.listeners    = []
+        self.condition    = threading.Condition()
+
+
+
+    def try_acquire(self):
+        """
+        Take a slot if one is free, and return whether it was taken.
+        """
+
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+
+
+    def acquire(self):
+        """
+        Block until a slot is free, and take it.
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+
+
+    def add_listener(self, callback):
+        """
+        Call callback() every time a slot is freed, from the thread that frees it.
+        """
+
+        with self.condition:
+            self.listeners.append(callback)
+
+
+
+    def remove_listener(self, callback):
+        """
+        Stop calling a callback given to add_listener.
+        """
+
+        with self.condition:
+            self.listeners.remove(callback)
+
+
+
+    def is_slow(self, key, latency):
+        """
+        Add the latency of an answer to the moving average of its kind of request, and return whether
+        that average is much higher than the lowest average seen for the same kind.
+        """
+
+        stats = self.latencies.get(key)
+        if stats is None:
+            stats = self.latencies[key] = {'latency': latency, 'baseline': latency}
+
+        stats['latency']  = 0.8 * stats['latency'] + 0.2 * latency
+        stats['baseline'] = min(stats['baseline'], stats['latency'])
+
+        # let the baseline drift up slowly, in case the server got slower for good
+        stats['baseline'] *= 1.001
+
+        return stats['latency'] > self.slow_factor * max(stats['baseline'], self.fast_latency)
+
+
+
+    def release(self, latency=None, overloaded=False, key=None):
+        """
+        Free a slot, and adapt the limit to how the request went.
+
+        Args:
+            latency: Seconds the request took, None if it failed without an answer.
+            overloaded: Redmine answered 429 or 5xx, or didn't answer.
+            key: The kind of request, see latency_key. Latencies are only compared within a kind.
+        """
+
+        with self.condition:
+            self.in_flight -= 1
+            self.answers   += 1
+
+            slow = latency is not None and not overloaded and self.is_slow(key, latency)
+
+            # the answers already on their way when the limit was lowered still show the old load, so
+            # slowness lowers it at most once per limit answers, and never below min_limit
+            if slow and self.answers >= self.limit and self.limit > self.min_limit:
+                overloaded = True
+
+            if overloaded:
+                self.limit     = max(self.min_limit, self.limit / 2)
+                self.successes = 0
+                self.answers   = 0
+
+            elif latency is not None and not slow:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit     = min(self.max_limit, self.limit + 1)
+                    self.successes = 0
+
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+
+        for callback in listeners:
+            callback()
+
+
+
+def latency_key(url, params=None):
+    """
+    Return the kind of a request for Concurrency_controller.release, its path and page size.
+    """
+
+    return urllib.parse.urlsplit(url).path, (params or {}).get('limit')
+
+
+
+def retry_delay(attempt, retry_after=None, max_retry_after=300, base=0.5, cap=30):
+    """
+    Return the seconds to wait before retrying a request, or None if it should not be retried.
+
+    Waits as long as the Retry-After header of the answer asks for if it has one (in seconds or as an
+    HTTP date), and gives up if that is longer than max_retry_after. Otherwise exponential backoff
+    with full jitter is used.
+
+    Args:
+        attempt: Number of the retry, starting at 0.
+        retry_after: The Retry-After header, or None.
+        max_retry_after: Most seconds to wait when Redmine asks for it with Retry-After.
+        base: Seconds to wait at most before the first retry.
+        cap: Most seconds to wait before a retry without Retry-After.
+    """
+
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+
+        if delay is not None:
+            return max(0, delay) if delay <= max_retry_after else None
+
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+
+# answers meaning Redmine is overloaded, the request is retried
+retry_statuses = {429, 500, 502, 503, 504}
+
+# failures meaning Redmine is overloaded or unreachable, the request is retried. A truncated body is what
+# an overloaded server often sends
+retry_exceptions = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+
+class Redmine_session(requests.Session):
+    """
+    A keep-alive session to the Redmine API, shared by all scripts.
+    """
+
+    def __init__(self, config):
+        """
+        Set up the connection pool, the auth header and the default timeout.
+        """
+
+        super().__init__()
+
+        self.url     = config['url']
+        self.timeout = config.get('timeout', 60)
+        self.workers = config.get('workers', 8)
+        self.cache   = Metadata_cache(os.path.expanduser(config.get('cache_path', '~/.cache/sll_vr_reporting_utils/metadata.sqlite')),
+                                      self.url,
+                                      ttl     = config.get('cache_ttl'),
+                                      refresh = config.get('refresh', False),
+                                      offline = config.get('offline', False))
+
+        # the local time entry store is opt-in
+        self.store        = None
+        self.store_synced = False
+        if config.get('store'):
+            self.store = Time_entry_store(os.path.expanduser(config.get('store_path', '~/.cache/sll_vr_reporting_utils/time_entries.sqlite')),
+                                          self.url,
+                                          reconcile_days = config.get('reconcile_days', 7))
+
+        # authenticate all requests with the api key header instead of a url parameter
+        self.headers.update({'X-Redmine-API-Key': config['api_key']})
+
+        # reuse the same connections for all requests
+        pool_size = config.get('pool_size', 10)
+        adapter   = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('http://',  adapter)
+        self.mount('https://', adapter)
+
+        # be gentle with Redmine, all fetches in the scripts share these
+        self.rate_limiter    = Rate_limiter(config.get('rate_limit', 20), config.get('rate_burst'))
+        self.concurrency     = Concurrency_controller(config.get('max_concurrency', self.workers), config.get('min_concurrency', 1))
+        self.retries         = config.get('retries', 5)
+        self.max_retry_after = config.get('max_retry_after', 300)
+
+
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request, using the default timeout unless one is given.
+
+        The request waits for the rate limiter and a free slot of the concurrency controller, and is retried
+        after a jittered backoff, or the time asked for in Retry-After, if Redmine is overloaded or doesn't answer.
+        """
+
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(self.retries + 1):
+
+            self.rate_limiter.wait()
+            self.concurrency.acquire()
+            start      = time.monotonic()
+            latency    = None
+            overloaded = False
+            response   = None
+            try:
+                response   = super().request(method, url, **kwargs)
+                latency    = time.monotonic() - start
+                overloaded = response.status_code in retry_statuses
+            except retry_exceptions:
+                overloaded = True
+                if attempt == self.retries:
+                    raise
+            finally:
+                # free the slot however the request went, a slot that is never freed blocks all later requests
+                self.concurrency.release(latency, overloaded, latency_key(url, kwargs.get('params')))
+
+            if not overloaded or attempt == self.retries:
+                return response
+
+            delay = retry_delay(attempt, response.headers.get('Retry-After') if response is not None else None, self.max_retry_after)
+            if delay is None:
+                # Redmine asks us to come back much later, give up
+                return response
+            time.sleep(delay)
+
+
+
+    def get_json(self, path, params=None):
+        """
+        Fetch a Redmine API path, e.g. 'projects.json', and return the decoded response.
+        """
+
+        response = self.get(f"{self.url}/{path}", params=params)
+        response.raise_for_status()
+        return response.json()
+
+
+
+    def get_pages(self, path, params=None, limit=100):
+        """
+        Yield every page of a paginated Redmine API path, in order.
+
+        The first page is fetched on its own to get the total count, the rest
+        of the offsets are then fetched at the same time by a bounded thread pool.
+        """
+
+        params = dict(params or {}, limit=limit, offset=0)
+
+        # the first page tells us how many pages there are
+        data = self.get_json(path, params)
+        yield data
+
+        # fetch the remaining pages in parallel, executor.map keeps them in order
+        offsets = range(limit, data.get('total_count', 0), limit)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            yield from executor.map(lambda offset: self.get_json(path, dict(params, offset=offset)), offsets)
+
+
+
+    def get_all(self, path, key, params=None):
+        """
+        Return the items of all pages of a Redmine API path as one list, e.g. get_all('users.json', 'users').
+        """
+
+        items = []
+        for data in self.get_pages(path, params):
+            items.extend(data[key])
+
+            # Calculate progress percentage
+            progress = len(items) / max(data.get('total_count', len(items)), 1) * 100
+            print(f'Fetching Redmine {key}: {len(items)} ({progress:.2f}%) complete           ', end='\r')
+
+        print(f'Fetching Redmine {key}: 100% complete                  ')
+        return items
+
+
+
+    def get_metadata(self, resource, path, key=None, params=None):
+        """
+        Return slowly changing metadata from the local cache, downloading it if it is missing or too old.
+
+        With a key, all pages of the path are fetched and the list of items under the key is returned,
+        otherwise the response of a single request is returned.
+        """
+
+        if key is None:
+            return self.cache.get(resource, lambda: self.get_json(path, params))
+
+        def is_unchanged(cached):
+            """
+            Check with two small requests that no item is newer than the cached ones, and that none were removed.
+            """
+
+            newer = self.get_json(path, dict(params or {}, limit=1, updated_on=f">={cached['updated_on']}"))
+            n_at_newest = sum( 1 for item in cached['data'] if item.get('updated_on') == cached['updated_on'] )
+            if newer.get('total_count') != n_at_newest:
+                return False
+
+            current = self.get_json(path, dict(params or {}, limit=1))
+            return current.get('total_count') == cached['total_count']
+
+        return self.cache.get(resource, lambda: self.get_all(path, key, params), is_unchanged)
+
+
+
+    def get_stored_time_entries(self, start_date, end_date, project_ids=None, user_ids=None, activity_ids=None):
+        """
+        Sync the local time entry store, unless offline, and return the matching time entries from it.
+        """
+
+        if not (self.cache.offline or self.store_synced):
+            self.store.sync(self)
+            self.store_synced = True
+
+        return self.store.query(start_date, end_date, project_ids, user_ids, activity_ids)
+
+
+
+    def get_issues(self, issue_ids, limit=100):
+        """
+        Yield lists of issues for the given ids, fetching up to limit issues per request.
+
+        Closed issues are included, and the batches are fetched in parallel.
+        """
+
+        issue_ids = list(issue_ids)
+        batches   = [ issue_ids[i:i+limit] for i in range(0, len(issue_ids), limit) ]
+
+        def fetch_batch(batch):
+            params = {'issue_id': ','.join(map(str, batch)), 'status_id': '*', 'limit': limit}
+            return self.get_json('issues.json', params)['issues']
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            yield from executor.map(fetch_batch, batches)
+
+
+
+# the session shared by everything in this run
+_session = None
+
+def get_session(config):
     """
-    A class to interact with the Redmine API.
+    Return the shared Redmine session, creating it on first use.
     """
 
+    global _session
+    if _session is None:
+        _session = Redmine_session(config)
 
+    return _session
 
 
-    def __init__(self, config):
+
+class Async_redmine:
+    """
+    An asyncio front end to a Redmine_session, with async versions of the time entry and issue fetches.
+    Metadata is fetched through the cache of the session, see Redmine_session.get_metadata.
+
+    Requests are sent with aiohttp if it is installed, otherwise the requests of the session are run
+    in threads. Either way a semaphore keeps at most session.workers requests in flight at once,
+    also when several fetches are run at the same time with asyncio.gather.
+    Use it through run_async from synchronous code.
+    """
+
+    def __init__(self, session, concurrency=None):
         """
-        Initialize the class with the Redmine configuration.
+        Wrap the session, allowing concurrency requests at a time (session.workers by default).
+        """
+
+        self.session     = session
+        self.concurrency = concurrency or session.workers
+        self.semaphore   = None
+        self.client      = None
+        self.slot_freed  = None
+        self.on_release  = None
+
+
+
+    async def __aenter__(self):
+        """
+        Create the semaphore, and the aiohttp client if it is used, in the running event loop.
         """
 
-        self.url      = config['url']
-        self.api_key  = config['api_key']
-        self.projects = self.get_project_structure()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        if aiohttp is not None:
 
+            # wake the requests waiting for a slot of the concurrency controller, which can be freed from any thread
+            loop            = asyncio.get_running_loop()
+            self.slot_freed = asyncio.Event()
+            self.on_release = lambda: loop.call_soon_threadsafe(self.slot_freed.set)
+            self.session.concurrency.add_listener(self.on_release)
 
+            self.client = aiohttp.ClientSession(headers=dict(self.session.headers),
+                                                timeout=aiohttp.ClientTimeout(total=self.session.timeout),
+                                                connector=aiohttp.TCPConnector(limit=self.concurrency))
+        return self
 
 
 
-    def get_project_structure(self):
+    async def __aexit__(self, *exc_info):
         """
-        Build a dict with the strucutre of the Redmine projects, and a name-id translation table.
+        Close the aiohttp client.
         """
 
-        params = {
-            'key': self.api_key,
-            'limit': 100,
-            'offset': 0
-        }
+        if self.client is not None:
+            self.session.concurrency.remove_listener(self.on_release)
+            await self.client.close()
+            self.client = None
 
-        # get the project list
-        redmine_projects = []
-        
-        response = requests.get(f"{self.url}/projects.json", params=params)
-        response.raise_for_status()
-        data = response.json()
 
-        redmine_projects.extend(data['projects'])
 
+    async def acquire_slot(self):
+        """
+        Wait until the concurrency controller of the session has a free slot, and take it.
+        """
 
-        total_count = data['total_count']
-        while params['offset'] < total_count:
-            response = requests.get(f"{self.url}/projects.json", params=params)
-            response.raise_for_status()
-            data = response.json()
+        while not self.session.concurrency.try_acquire():
 
+            # a slot freed between the failed try and clearing the event would be missed, so try again after clearing
+            self.slot_freed.clear()
+            if self.session.concurrency.try_acquire():
+                return
+            await self.slot_freed.wait()
 
-            redmine_projects.extend(data['projects'])
 
-            params['offset'] += params['limit']
 
-            # Calculate progress percentage
-            progress = min(params['offset'], total_count) / total_count * 100
-            print(f'Fetching Redmine projects: {min(params["offset"], total_count)} ({progress:.2f}%) complete           ', end='\r')
+    async def get_json(self, path, params=None):
+        """
+        Fetch a Redmine API path, e.g. 'projects.json', and return the decoded response.
+        """
+
+        async with self.semaphore:
+
+            # fall back to the blocking session, run in a thread, which is throttled and retried by the session
+            if self.client is None:
+                return await asyncio.to_thread(self.session.get_json, path, params)
+
+            url = f"{self.session.url}/{path}"
+            key = latency_key(url, params)
+
+            # aiohttp only takes string parameters
+            params = { name: str(value) for name, value in (params or {}).items() }
+
+            # the same throttling and retries as Redmine_session.request
+            for attempt in range(self.session.retries + 1):
+
+                await asyncio.sleep(self.session.rate_limiter.reserve())
+                await self.acquire_slot()
+
+                start      = time.monotonic()
+                latency    = None
+                overloaded = False
+                delay      = None
+                try:
+                    async with self.client.get(url, params=params) as response:
+                        latency    = time.monotonic() - start
+                        overloaded = response.status in retry_statuses
+                        if overloaded and attempt < self.session.retries:
+                            delay = retry_delay(attempt, response.headers.get('Retry-After'), self.session.max_retry_after)
+
+                        # done, or given up
+                        if delay is None:
+                            response.raise_for_status()
+                            return await response.json(content_type=None)
+
+                except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                    overloaded = True
+                    if attempt == self.session.retries:
+                        raise
+                    delay = retry_delay(attempt)
+
+                finally:
+                    # free the slot however the request went, also when the task is cancelled
+                    self.session.concurrency.release(latency, overloaded, key)
+
+                await asyncio.sleep(delay)
+
+
+
+    async def get_time_entries(self, start_date, end_date, params=None, limit=100):
+        """
+        Yield the pages of time entries spent between two dates (inclusive) matching the params, as they arrive.
+
+        The period is split into one shard per month, and each shard is paged through sorted by creation
+        time and id, so that entries logged during the fetch end up on the last page instead of shifting
+        the entries of the pages not fetched yet. The first page of every shard is fetched at once, then
+        all remaining pages of all shards. The total_count of each page is the total of all shards, so
+        that progress can be shown as with a single query.
+
+        Pages come in any order, and an entry moved between months during the fetch can be in two
+        shards, see merge_time_entries.
+        """
+
+        shards = [ dict(params or {}, spent_on=f'><{first}|{last}', sort='created_on,id', limit=limit, offset=0) for first, last in month_ranges(start_date, end_date) ]
+
+        # the first pages tell us how many pages each shard has
+        first_pages = await asyncio.gather(*[ self.get_json('time_entries.json', shard) for shard in shards ])
+        total_count = sum( data.get('total_count', 0) for data in first_pages )
+        for data in first_pages:
+            yield dict(data, total_count=total_count)
+
+        pages = [ asyncio.ensure_future(self.get_json('time_entries.json', dict(shard, offset=offset)))
+                  for shard, data in zip(shards, first_pages)
+                  for offset in range(limit, data.get('total_count', 0), limit) ]
+        try:
+            for page in asyncio.as_completed(pages):
+                yield dict(await page, total_count=total_count)
+        finally:
+            # don't leave requests running if the caller stops early
+            for page in pages:
+                page.cancel()
+
+
+
+    async def get_issues(self, issue_ids, limit=100):
+        """
+        Yield lists of issues for the given ids, fetching up to limit issues per request.
+
+        Closed issues are included, and the batches are yielded as soon as they arrive, in any order.
+        """
+
+        issue_ids = list(issue_ids)
+        batches   = [ issue_ids[i:i+limit] for i in range(0, len(issue_ids), limit) ]
+
+        for issues in asyncio.as_completed([ self._get_issue_batch(batch, limit) for batch in batches ]):
+            yield await issues
+
+
+
+    async def get_queued_issues(self, queue, limit=100):
+        """
+        Fetch the issues of the ids put in an asyncio.Queue, until None is put in it, and return them as a list.
+
+        Ids are put in the queue as lists of any length, e.g. one list per page of time entries, and each id is
+        only fetched once. A batch is requested as soon as limit new ids have been queued, so the issues are
+        fetched while the ids are still being found, and the last partial batch when the queue is closed.
+        """
+
+        seen    = set()
+        pending = []
+        batches = []
+        while True:
+
+            issue_ids = await queue.get()
+            if issue_ids is None:
+                break
+
+            for issue_id in issue_ids:
+                if issue_id not in seen:
+                    seen.add(issue_id)
+                    pending.append(issue_id)
+
+            # start fetching every full batch right away
+            while len(pending) >= limit:
+                batches.append(asyncio.ensure_future(self._get_issue_batch(pending[:limit], limit)))
+                pending = pending[limit:]
+
+        if pending:
+            batches.append(asyncio.ensure_future(self._get_issue_batch(pending, limit)))
+
+        return [ issue for issues in await asyncio.gather(*batches) for issue in issues ]
+
+
+
+    async def _get_issue_batch(self, issue_ids, limit):
+        """
+        Fetch the issues of up to limit ids in one request, closed ones included.
+        """
+
+        params = {'issue_id': ','.join(map(str, issue_ids)), 'status_id': '*', 'limit': limit}
+        return (await self.get_json('issues.json', params))['issues']
+
+
 
-        print('Fetching Redmine projects: 100% complete                  ')
+def month_ranges(start_date, end_date):
+    """
+    Split a period between two YYYY-MM-DD dates (inclusive) into a (first, last) pair of dates per calendar month.
+    """
+
+    start  = datetime.date.fromisoformat(start_date)
+    end    = datetime.date.fromisoformat(end_date)
+    ranges = []
+    while start <= end:
+        month_end = start.replace(day=calendar.monthrange(start.year, start.month)[1])
+        ranges.append((start.isoformat(), min(month_end, end).isoformat()))
+        start = month_end + datetime.timedelta(days=1)
+
+    return ranges
+
+
+
+def merge_time_entries(time_entry_lists):
+    """
+    Merge lists of Time_entry records from several queries, keeping each entry once.
+
+    The entries are sorted like Redmine sorts them by default, newest spent_on first and, within a day,
+    the newest entry first, so that the reports list things in the same order as with a single query
+    however the entries were fetched. Redmine sorts a day on created_on, the id is used here as it
+    increases with created_on.
+    """
+
+    time_entries = {}
+    for time_entry_list in time_entry_lists:
+        for entry in time_entry_list:
+            time_entries.setdefault(entry.id, entry)
+
+    return sorted(time_entries.values(), key=lambda entry: (entry.spent_on, entry.id), reverse=True)
+
+
+
+def run_async(session, fetch, *args, **kwargs):
+    """
+    Run the coroutine function fetch(async_redmine, *args, **kwargs) from synchronous code and return its result.
+
+    A new event loop is used for each call, with an Async_redmine around the session.
+    """
+
+    async def main():
+        async with Async_redmine(session) as redmine:
+            return await fetch(redmine, *args, **kwargs)
+
+    return asyncio.run(main())
+
+
+
+class Issue:
+    """
+    A compact record of an issue, with only the fields used by the reports.
+
+    The tracker, project and assignee names are interned, and the custom fields are kept as a name -> value dict.
+    spent_per_activity and report_type are filled in by the reports.
+    """
+
+    __slots__ = ('id', 'subject', 'project_id', 'project_name', 'tracker', 'assigned_to', 'spent_hours', 'custom_fields', 'spent_per_activity', 'report_type')
+
+    def __init__(self, issue):
+        """
+        Make a record from an issue as returned by the Redmine API.
+        """
+
+        self.id           = issue['id']
+        self.subject      = issue.get('subject', '')
+        self.project_id   = issue['project']['id']
+        self.project_name = intern(issue['project'].get('name', ''))
+        self.tracker      = intern(issue.get('tracker', {}).get('name', ''))
+        self.assigned_to  = intern((issue.get('assigned_to') or {}).get('name', ''))
+        self.spent_hours  = issue.get('spent_hours', '')
+
+        # keep the first value if a custom field name is used more than once, like a linear search would
+        self.custom_fields = {}
+        for field in issue.get('custom_fields', []):
+            self.custom_fields.setdefault(intern(field['name']), field.get('value'))
+
+        self.spent_per_activity = {}
+        self.report_type        = None
+
+
+
+    def copy(self, **changes):
+        """
+        Return a shallow copy of the record, with the given fields changed.
+        """
+
+        issue = copy.copy(self)
+        for field, value in changes.items():
+            setattr(issue, field, value)
+
+        return issue
+
+
+
+class Time_entry:
+    """
+    A compact record of a time entry, with only the fields used by the reports and the names interned.
+    """
+
+    __slots__ = ('id', 'hours', 'spent_on', 'issue_id', 'project_id', 'project_name', 'user_id', 'user_name', 'activity_id', 'activity_name')
+
+    def __init__(self, entry):
+        """
+        Make a record from a time entry as returned by the Redmine API, issue_id is None if the entry has no issue.
+        """
+
+        self.id            = entry['id']
+        self.hours         = entry['hours']
+        self.spent_on      = entry.get('spent_on')
+        self.issue_id      = entry['issue']['id'] if 'issue' in entry else None
+        self.project_id    = entry['project']['id']
+        self.project_name  = intern(entry['project'].get('name', ''))
+        self.user_id       = entry['user']['id']
+        self.user_name     = intern(entry['user'].get('name', ''))
+        self.activity_id   = entry['activity']['id']
+        self.activity_name = intern(entry['activity']['name'])
+
+
+
+def get_custom_field(issue, field_name):
+    """
+    Get a custom field value from an Issue record, or '' if it is not set.
+    """
+
+    return issue.custom_fields.get(field_name, '')
+
+
+
+
+
+class Redmine_utils:
+    """
+    A class to interact with the Redmine API.
+    """
+
+
+
+
+    def __init__(self, config):
+        """
+        Initialize the class with the Redmine configuration.
+        """
+
+        self.url       = config['url']
+        self.api_key   = config['api_key']
+        self.session   = get_session(config)
+        self._projects = None
+
+
+
+    @property
+    def projects(self):
+        """
+        The Redmine project structure, fetched the first time it is used and shared after that.
+        """
+
+        if self._projects is None:
+            self._projects = self.get_project_structure()
 
-        # Initialize an empty dictionary to store the hierarchy
-        projects_dict = {}
+        return self._projects
+
+
+
+
+
+    def get_project_structure(self):
+        """
+        Build a dict with the strucutre of the Redmine projects, and a name-id translation table.
+
+        The hierarchy is indexed in one pass over the projects: each project gets the set of all
+        projects below it as 'children', and utils has the direct children and toplevel project of each id.
+        """
+
+        # get the project list, from the local cache if it is up to date
+        redmine_projects = self.session.get_metadata('projects', 'projects.json', 'projects')
 
         # restructure projects at a dict
         redmine_projects = { proj['id']:proj for proj in redmine_projects }
@@ -77,54 +1337,109 @@ class Redmine_utils:
         redmine_projects['utils']['identifier2name'] = {}
         redmine_projects['utils']['id2identifier']   = {}
         redmine_projects['utils']['identifier2id']   = {}
-    
-    
-        # Function to recursively build the dictionary
-        def build_project_hierarchy(project, child_ids):
-            """
-            Recursively build the project hierarchy.
-            """
-            
+        redmine_projects['utils']['id2children']     = {}
+        redmine_projects['utils']['id2toplevel']     = {}
+
+        # readability
+        utils    = redmine_projects['utils']
+        projects = [ project for key,project in redmine_projects.items() if key != 'utils' ]
+
+        # first pass, fill the translation tables and the parent -> direct children adjacency
+        toplevel_ids = []
+        for project in projects:
+
             # add name conversions to translation tables
-            redmine_projects['utils']['name2id'][project['name']]               = project['id']
-            redmine_projects['utils']['id2name'][project['id']]                 = project['name']
-            redmine_projects['utils']['name2identifier'][project['name']]       = project['identifier']
-            redmine_projects['utils']['identifier2name'][project['identifier']] = project['name']
-            redmine_projects['utils']['id2identifier'][project['id']]           = project['identifier']
-            redmine_projects['utils']['identifier2id'][project['identifier']]   = project['id']
-
-            # if there are any children to be added
-            if len(child_ids) > 0:
-                try:
-                    redmine_projects[project['id']]['children'].update(child_ids)
-                except:
-                    redmine_projects[project['id']]['children'] = set()
-                    redmine_projects[project['id']]['children'].update(child_ids)
+            utils['name2id'][project['name']]               = project['id']
+            utils['id2name'][project['id']]                 = project['name']
+            utils['name2identifier'][project['name']]       = project['identifier']
+            utils['identifier2name'][project['identifier']] = project['name']
+            utils['id2identifier'][project['id']]           = project['identifier']
+            utils['identifier2id'][project['identifier']]   = project['id']
 
-            # if we have reached the top
-            if 'parent' not in project:
-                return
+            # projects without a (visible) parent are the roots of the tree
+            parent_id = project.get('parent', {}).get('id')
+            if parent_id in redmine_projects:
+                utils['id2children'].setdefault(parent_id, []).append(project['id'])
+            else:
+                toplevel_ids.append(project['id'])
+
+        # walk down from each toplevel project, noting the toplevel project of every project on the way
+        walk_order = []
+        for toplevel_id in toplevel_ids:
+            stack = [toplevel_id]
+            while stack:
+                proj_id = stack.pop()
+                walk_order.append(proj_id)
+                utils['id2toplevel'][proj_id] = toplevel_id
+                stack.extend(utils['id2children'].get(proj_id, []))
+
+        # parents are walked before their children, so going backwards all children are done before their parent
+        for proj_id in reversed(walk_order):
+            child_ids = set()
+            for child_id in utils['id2children'].get(proj_id, []):
+                child_ids.add(child_id)
+                child_ids.update(redmine_projects[child_id].get('children', set()))
+
+            # all projects below this one, not just the direct children
+            if child_ids:
+                redmine_projects[proj_id]['children'] = child_ids
+
+        return redmine_projects
+
+
+
+    def resolve_project_id(self, name):
+        """
+        Return the project id of a project given by id, identifier or name, or None if there is no such project.
+        """
+
+        # readability
+        utils = self.projects['utils']
+
+        # ids can be given both as ints and as strings
+        if str(name).isdigit() and int(name) in utils['id2name']:
+            return int(name)
+
+        if name in utils['identifier2id']:
+            return utils['identifier2id'][name]
+
+        return utils['name2id'].get(name)
 
-            # add this project and its children to the list of children
-            child_ids.add(project['id'])
-            child_ids.update(redmine_projects[project['id']].get('children', set()))
 
-            # pass on the child list to the parent
-            build_project_hierarchy(redmine_projects[project['parent']['id']], child_ids=child_ids)
 
+    def resolve_projects(self, names, recursive=False):
+        """
+        Resolve a list of project ids/identifiers/names to project ids.
+
+        Returns the set of matching project ids, including all projects below them if recursive
+        is set, and the list of names that didn't match any project.
+        """
+
+        project_ids = set()
+        unmatched   = []
 
-        # process each project
-        for key,project in redmine_projects.items():
+        for name in names:
 
-            # skip utility key
-            if key == 'utils':
+            project_id = self.resolve_project_id(name)
+            if project_id is None:
+                unmatched.append(name)
                 continue
 
-            build_project_hierarchy(project, child_ids=set())
+            project_ids.add(project_id)
+            if recursive:
+                project_ids.update(self.get_subtree(project_id))
 
+        return project_ids, unmatched
 
 
-        return redmine_projects
+
+    def get_activities(self):
+        """
+        Return a dict of the active time entry activities, id to name.
+        """
+
+        activities = self.session.get_metadata('activities', 'enumerations/time_entry_activities.json', 'time_entry_activities')
+        return { activity['id']:activity['name'] for activity in activities }
 
 
 
@@ -133,12 +1448,16 @@ class Redmine_utils:
         Return the project id of the toplevel project that a project is a child of.
         """
 
-        # if this is not a toplevel project, return the parent's toplevel project
-        if self.projects[proj_id].get("parent"):
-            return self.get_toplevel_project(self.projects[proj_id]['parent']['id'])
-        # if there is no parent, this is a toplevel project
-        else:
-            return proj_id
+        return self.projects['utils']['id2toplevel'][proj_id]
+
+
+
+    def get_subtree(self, proj_id):
+        """
+        Return the ids of all projects below a project, not including the project itself.
+        """
+
+        return self.projects[proj_id].get('children', set())
 
 
 
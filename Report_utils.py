@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import xlsxwriter
+
+
+
+class Report_writer:
+    """
+    An Excel workbook written in xlsxwriter's constant_memory mode, shared by all report scripts.
+
+    Each row is written to disk as soon as a later row of the same sheet is written, so the memory used
+    doesn't grow with the number of rows. This means the rows of a sheet have to be written in order,
+    and everything in a row, including set_row, has to be written before moving on to the next row.
+    """
+
+    def __init__(self, output_path, constant_memory=True):
+        """
+        Create the workbook.
+        """
+
+        self.output_path = output_path
+        self.workbook    = xlsxwriter.Workbook(output_path, {'constant_memory': constant_memory})
+        self.formats     = {}
+
+
+
+    def format(self, **properties):
+        """
+        Return a cell format with the given properties, creating it only the first time it is asked for.
+        """
+
+        key = tuple(sorted(properties.items()))
+        if key not in self.formats:
+            self.formats[key] = self.workbook.add_format(properties)
+
+        return self.formats[key]
+
+
+
+    def add_worksheet(self, name):
+        """
+        Add a worksheet to the workbook.
+        """
+
+        return self.workbook.add_worksheet(name)
+
+
+
+    def add_chart(self, options):
+        """
+        Add a chart to the workbook, to be inserted in a worksheet.
+        """
+
+        return self.workbook.add_chart(options)
+
+
+
+    def write_row(self, sheet, row_num, values, cell_format=None, first_col=0):
+        """
+        Write a whole row of values, starting at first_col.
+
+        A value can be given as a (value, format) tuple to use another format than cell_format for that cell.
+        Strings starting with = are written as formulas, and None or '' leaves the cell empty.
+        """
+
+        # write it in one go if all cells use the same format
+        if not any(isinstance(value, tuple) for value in values):
+            sheet.write_row(row_num, first_col, values, cell_format)
+            return
+
+        for col_num, value in enumerate(values, first_col):
+            if isinstance(value, tuple):
+                sheet.write(row_num, col_num, *value)
+            else:
+                sheet.write(row_num, col_num, value, cell_format)
+
+
+
+    def close(self):
+        """
+        Write the rest of the workbook to disk.
+        """
+
+        self.workbook.close()
@@ -1,13 +1,14 @@
 from collections import defaultdict
 from pprint import pprint
 import argparse
+import asyncio
 import csv
+import numpy as np
 import pdb
-import requests
 import sys
 import yaml
-from Redmine_utils import Redmine_utils
-import xlsxwriter
+from Redmine_utils import Redmine_utils, Time_entry, Time_entry_batch, add_cache_arguments, merge_time_entries, run_async
+from Report_utils import Report_writer
 from xlsxwriter.utility import xl_col_to_name
 
 def parse_arguments():
@@ -24,27 +25,30 @@ def parse_arguments():
     parser.add_argument('-s', '--start_date',         help='Start date of the interval (YYYY-MM-DD).')
     parser.add_argument('-t', '--exclude-timelogbot', help='Use to exclude all time entries created by timelogbot.', action='store_true')
     parser.add_argument('-y', '--year', type=int,     help='Shortcut to set -s (YYYY-1)-12-01 and -e YYYY-11-30.')
+    parser.add_argument('--rule-stats',               help='Use to print how many time entries each percent matrix rule matched.', action='store_true')
+    parser.add_argument('--values',                   help='Use to write the totals, percentages and averages as computed numbers instead of Excel formulas.', action='store_true')
+    parser.add_argument('--formula-audit',            help='Use to add a sheet listing the formulas behind the computed columns.', action='store_true')
+    add_cache_arguments(parser)
 
     return parser.parse_args()
 
 def load_config(path):
     """
-    Load Redmine URL and API key from a YAML config file.
+    Load Redmine URL, API key and connection settings from a YAML config file.
     Args:
         path: The path to the YAML config file.
     Returns:
-        The Redmine URL and API key.
+        The config dict.
     """
     with open(path, 'r') as f:
         config = yaml.safe_load(f)
-    return config['url'], config['api_key']
+    return config
 
-def get_group_id(redmine_url, api_key, group_name):
+def get_group_id(session, group_name):
     """
     Get the ID of a group by its name.
     Args:
-        redmine_url: The Redmine URL.
-        api_key: The API key.
+        session: The shared Redmine session.
         group_name: The name of the group.
     Returns:
         The ID of the group.
@@ -54,9 +58,7 @@ def get_group_id(redmine_url, api_key, group_name):
     if not group_name:
         return None
 
-    response = requests.get(f"{redmine_url}/groups.json", params={"key": api_key})
-    response.raise_for_status()
-    groups = response.json()["groups"]
+    groups = session.get_metadata('groups', 'groups.json', 'groups')
     for group in groups:
         if group["name"] == group_name:
             return group["id"]
@@ -64,7 +66,7 @@ def get_group_id(redmine_url, api_key, group_name):
 
 
 
-def classify_project(lexicon_name, proj_id):
+def classify_project(lexicon_name, proj_id, redmine):
     """
     Return the classification of a project according the requested lexicon.
     """
@@ -81,11 +83,11 @@ def classify_project(lexicon_name, proj_id):
     if lexicon_name not in lexicon:
         sys.exit(f"ERROR: Lexicon not defined: {lexicon_name}")
 
-    # check if the proj_id is a name if it is not found
-    if proj_id not in projects:
+    # check if the proj_id is a name or identifier if it is not found
+    if proj_id not in redmine.projects:
 
-        possible_proj_id = [ proj['id'] for proj in projects if proj['name'] == proj_id ]
-        if len(possible_proj_id) == 1:
+        possible_proj_id = redmine.resolve_project_id(proj_id)
+        if possible_proj_id is not None:
             proj_id = possible_proj_id
         else:
             # how will deleted projects work here?
@@ -93,74 +95,147 @@ def classify_project(lexicon_name, proj_id):
 
 
     # return the classification if found, otherwise return the default classification for the lexicon
-    return lexicon[lexicon_name].get(projects[proj_id]['name'], lexicon[lexicon_name]['default'])
+    return lexicon[lexicon_name].get(redmine.projects[proj_id]['name'], lexicon[lexicon_name]['default'])
+
+
+
+# rules used to classify time for the percent matrix, the first matching rule is used.
+#   column:       percent matrix column the hours are added to, None to not count the hours at all
+#   toplevel:     names of the toplevel projects the rule applies to
+#   not_toplevel: names of the toplevel projects the rule does not apply to
+#   activities:   names of the activities the rule applies to
+#   issues:       ids of the issues the rule applies to
+# a rule applies to everything if a condition is left out.
+percent_matrix_rules = [
+    {'name': 'SMS support',                      'column': 'Support SMS',         'toplevel': ["National Bioinformatics Support"], 'activities': ["Support", "Consultation"]},
+    {'name': 'LTS support',                      'column': 'Support LTS',         'toplevel': ["Long-term Support"],               'activities': ["Support", "Consultation"]},
+    {'name': 'ELIXIR issue',                     'column': 'ELIXIR',              'issues': [3774]},
+    {'name': 'Not counted',                      'column': None,                  'activities': ["Professional Development", "Absence (Vacation/VAB/Other)", "Internal NBIS", "Administration", "Internal consultation"]},
+    {'name': 'Consultation in other projects',   'column': 'Support SMS',         'not_toplevel': ["National Bioinformatics Support", "Long-term Support"], 'activities': ["Consultation"]},
+    {'name': 'Consultation issues',              'column': 'Support SMS',         'issues': [3499, 7000], 'activities': ["Consultation"]},
+    {'name': 'Management',                       'column': 'Centrala funkt',      'activities': ["NBIS Management"]},
+    {'name': 'Data management',                  'column': 'Data mgmt',           'activities': ["Support (DM)", "Consultation (DM)"]},
+    {'name': 'Development',                      'column': 'Pipelines & Tools',   'activities': ["Development"]},
+    {'name': 'Training',                         'column': 'Training & Nat netw', 'activities': ["Training", "Outreach"]},
+    {'name': 'Support in other projects',        'column': 'Övrigt',              'not_toplevel': ["National Bioinformatics Support", "Long-term Support"], 'activities': ["Support"]},
+]
+
+
+
+class Percent_matrix_classifier:
+    """
+    Classifies time entries for the percent matrix according to a rule table.
 
+    The rules are only evaluated the first time a (toplevel project id, activity id, issue id) combination is seen,
+    after that the matching rule is looked up directly. Issue ids not used by any rule are left out of the key.
+    """
 
+    def __init__(self, rules, projects):
+        """
+        Compile the rule table, with the conditions as sets.
+        """
 
-def get_time_entries(redmine_url, api_key, group_id, date_interval, redmine, projects, exclude_timelogbot=False):
-    """
-    Fetch spent time data from Redmine for a specific group.
-    Args:
-        redmine_url: The Redmine URL.
-        api_key: The API key.
-        group_id: The ID of the group.
-        date_interval: The date interval.
-    Returns:
-        A dictionary with the spent time data.
-    """
-    spent_time_data     = defaultdict(lambda: defaultdict(float))
-    percent_matrix_data = {}
+        self.projects = projects
+        self.rules    = []
+        for rule in rules:
+            self.rules.append({
+                'name'        : rule['name'],
+                'column'      : rule.get('column'),
+                'toplevel'    : set(rule['toplevel'])     if 'toplevel'     in rule else None,
+                'not_toplevel': set(rule['not_toplevel']) if 'not_toplevel' in rule else set(),
+                'activities'  : set(rule['activities'])   if 'activities'   in rule else None,
+                'issues'      : set(rule['issues'])       if 'issues'       in rule else None,
+            })
+
+        # the issue ids that any rule looks at, all other issues are classified the same
+        self.rule_issues = set().union(*[ rule['issues'] for rule in self.rules if rule['issues'] ])
+
+        self.dispatch = {}
+        self.stats    = defaultdict(lambda: {'entries': 0, 'hours': 0})
 
 
 
+    def match(self, toplevel_name, activity_name, issue_id):
+        """
+        Return the first rule matching the entry, or None.
+        """
+
+        for rule in self.rules:
+            if rule['toplevel']   is not None and toplevel_name not in rule['toplevel']:
+                continue
+            if toplevel_name in rule['not_toplevel']:
+                continue
+            if rule['activities'] is not None and activity_name not in rule['activities']:
+                continue
+            if rule['issues']     is not None and issue_id not in rule['issues']:
+                continue
+            return rule
 
+        return None
 
-    ### get user info
 
-    # Set up headers with the API key
-    headers = {'X-Redmine-API-Key': api_key}
 
-    # Initialize variables for pagination
-    offset      = 0
-    limit       = 100
-    total_users = float('inf')  # Set an initial value greater than zero
-    users_all   = {}
+    def classify(self, toplevel_proj, activity_id, activity_name, issue_id=None):
+        """
+        Return the rule that applies to time logged in a toplevel project, activity and issue, or None if it is not classified.
+        """
 
-    while offset < total_users:
-        # Construct the API endpoint URL for listing users with pagination
-        users_endpoint = f'{redmine_url}/users.json?offset={offset}&limit={limit}'
+        if issue_id not in self.rule_issues:
+            issue_id = None
 
-        # Make the GET request to the Redmine API
-        response = requests.get(users_endpoint, headers=headers)
+        key = (toplevel_proj, activity_id, issue_id)
+        try:
+            return self.dispatch[key]
+        except KeyError:
+            rule = self.dispatch[key] = self.match(self.projects[toplevel_proj]['name'], activity_name, issue_id)
+            return rule
 
-        # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            # Parse the JSON response to get user data
-            users_data = response.json()
 
-            # Update total_users based on the total count from the first page
-            if offset == 0:
-                total_users = users_data['total_count']
 
-            # Extract and print user information
-            for user in users_data['users']:
-                users_all[user['id']] = {'firstname': user['firstname'], 'lastname':user['lastname'], 'mail':user['mail'], 'time':{}}
+    def count(self, rule, entries, hours):
+        """
+        Keep track of how many time entries and hours a rule matched.
+        """
 
-            # Update the offset for the next page
-            offset += limit
+        stats = self.stats[rule['name'] if rule else 'Not classified']
+        stats['entries'] += entries
+        stats['hours']   += hours
 
-        else:
-            # Print an error message if the request was not successful
-            print(f"Error: Unable to fetch users. Status Code: {response.status_code}")
-            break
+
+
+    def print_stats(self):
+        """
+        Print how many time entries and hours each rule matched.
+        """
+
+        print(f"{'Rule':<35} {'Entries':>8} {'Hours':>10}")
+        for name in [ rule['name'] for rule in self.rules ] + ['Not classified']:
+            stats = self.stats.get(name, {'entries': 0, 'hours': 0})
+            print(f"{name:<35} {stats['entries']:>8} {stats['hours']:>10.2f}")
+
+
+
+def get_users(session, group_id):
+    """
+    Get the users to report on, all users or only the members of a group.
+    Args:
+        session: The shared Redmine session.
+        group_id: The ID of the group, None for all users.
+    Returns:
+        A dictionary with the user info, by user id.
+    """
+
+    users_all = {}
+
+    # fetch all users, from the local cache if it is up to date
+    for user in session.get_metadata('users', 'users.json', 'users'):
+        users_all[user['id']] = {'firstname': user['firstname'], 'lastname':user['lastname'], 'mail':user['mail'], 'time':{}}
 
 
     # if a group is to be filtered out
     if group_id:
         # Fetch group members
-        response = requests.get(f"{redmine_url}/groups/{group_id}.json", params={"key": api_key, "include": "users"})
-        response.raise_for_status()
-        group = response.json()["group"]
+        group = session.get_metadata(f"groups/{group_id}", f"groups/{group_id}.json", params={"include": "users"})["group"]
         user_ids = [user["id"] for user in group["users"]]
 
         # filter out group members
@@ -169,180 +244,292 @@ def get_time_entries(redmine_url, api_key, group_id, date_interval, redmine, pro
     else:
         users = users_all
 
+    return users
+
+
+
+def get_time_entries(session, group_id, date_interval, redmine, projects, exclude_timelogbot=False, rule_stats=False):
+    """
+    Fetch spent time data from Redmine for a specific group.
+    Args:
+        session: The shared Redmine session.
+        group_id: The ID of the group.
+        date_interval: The date interval.
+    Returns:
+        A dictionary with the spent time data.
+    """
+
+    # Fetch all time entries in the date interval, from the local store if it is used
+    if session.store:
+        users = get_users(session, group_id)
+        time_entries = list(map(Time_entry, session.get_stored_time_entries(date_interval['>='], date_interval['<='])))
+        print(f"Fetched {len(time_entries)} time entries")
+
+    else:
+        async def fetch_time_entries(redmine):
+            # keep compact records of the time entries, fetched one shard per month
+            time_entries = []
+            async for page in redmine.get_time_entries(date_interval['>='], date_interval['<=']):
+                time_entries.extend(map(Time_entry, page["time_entries"]))
+                print(f"Fetched {len(time_entries)} time entries")
+            return time_entries
+
+        async def fetch_all(redmine):
+            # get the user info while the time entries are being fetched
+            return await asyncio.gather(asyncio.to_thread(get_users, session, group_id), fetch_time_entries(redmine))
+
+        users, time_entries = run_async(session, fetch_all)
+
+        # the months are fetched at the same time, put the entries back in order
+        time_entries = merge_time_entries([time_entries])
 
+    return summarize_time_entries(time_entries, users, redmine, projects, exclude_timelogbot, rule_stats)
+
+
+
+def summarize_time_entries(time_entries, users, redmine, projects, exclude_timelogbot=False, rule_stats=False):
+    """
+    Summarize time entries per support type and user, and per user for the percent matrix.
+    Args:
+        time_entries: Time_entry records.
+        users: The users to include, from get_users.
+        redmine: Redmine_utils object.
+        projects: The Redmine project structure.
+        rule_stats: Print how many time entries each percent matrix rule matched.
+    Returns:
+        A dictionary with the spent time data, and one with the percent matrix data.
+    """
+    classifier = Percent_matrix_classifier(percent_matrix_rules, projects)
+
+    # decode the time entries into columns
+    batch = Time_entry_batch(time_entries)
+
+    # only include the users we are interested in, skip timelog importer if requested
+    selected = np.isin(batch.user_ids, list(users))
+    if exclude_timelogbot:
+        selected &= np.isin(batch.user_ids, [ user_id for user_id, name in batch.user_names.items() if name == "Timelog Importer" ], invert=True)
+
+    # get the toplevel project of each entry, and classify it to make it end up in the right sheet, once per project
+    project_keys, project_index = batch.group([batch.project_ids])
+    toplevels     = np.array([ redmine.get_toplevel_project(project_id) for (project_id,) in project_keys ], dtype=np.int64)
+    support_types = [ classify_project('bengts_report', toplevel_proj, redmine) for toplevel_proj in toplevels.tolist() ]
+    support_names = list(dict.fromkeys(support_types))
+    toplevel_ids  = toplevels[project_index]
+    support_codes = np.array([ support_names.index(support_type) for support_type in support_types ], dtype=np.int64)[project_index]
+
+
+    # save time data, the total per support type and user
+    spent_time_data = {}
+    for (support_code, user_id), hours in batch.sum_hours([support_codes, batch.user_ids], selected).items():
+        spent_time_data.setdefault(support_names[support_code], {})[user_id] = {'firstname'       : users[user_id]['firstname'],
+                                                                                'lastname'        : users[user_id]['lastname'],
+                                                                                'email'           : users[user_id]['mail'],
+                                                                                'total spent time': hours,
+                                                                                'issues'          : set(),
+                                                                                'spent_time'      : {},
+                                                                               }
+
+    # per activity and toplevel project
+    for (support_code, user_id, activity_code, toplevel_proj), hours in batch.sum_hours([support_codes, batch.user_ids, batch.activity_codes, toplevel_ids], selected).items():
+        spent_time_data[support_names[support_code]][user_id]['spent_time'].setdefault(batch.activity_names[activity_code], {})[toplevel_proj] = hours
+
+    # and per activity
+    for (support_code, user_id, activity_code), hours in batch.sum_hours([support_codes, batch.user_ids, batch.activity_codes], selected).items():
+        spent_time_data[support_names[support_code]][user_id]['spent_time'][batch.activity_names[activity_code]]['total'] = hours
+
+    # the issues each user has logged time on
+    has_issue = batch.issue_ids >= 0
+    for support_code, user_id, issue_id in batch.group([support_codes, batch.user_ids, batch.issue_ids], selected & has_issue)[0]:
+        spent_time_data[support_names[support_code]][user_id]['issues'].add(issue_id)
 
-    # Fetch all time entries in the date interval
-    params = {"key": api_key, "spent_on": f"><{date_interval['>=']}|{date_interval['<=']}", "limit": 100}
-    offset = 0
     time_without_issue = 0
-    while True:
-        params["offset"] = offset
-        response = requests.get(f"{redmine_url}/time_entries.json", params=params)
-        response.raise_for_status()
-        entries = response.json()["time_entries"]
-        if not entries:
-            break
-        for entry in entries:
-
-            # skip timelog importer if requested
-            if exclude_timelogbot and entry['user']['name'] == "Timelog Importer":
-                continue
+    for i in np.flatnonzero(selected & ~has_issue):
+        entry = time_entries[i]
+        print(f"WARNING: Time entry without issue id by user '{entry.user_name}' in project '{entry.project_name}': https://projects.nbis.se/time_entries/{entry.id}/edit")
+        time_without_issue += entry.hours
 
-            # get info
-            user_id = entry["user"]["id"]
-            toplevel_proj = redmine.get_toplevel_project(entry['project']['id'])
-
-            # classify the project to make it end up in the right sheet
-            support_type = classify_project('bengts_report', toplevel_proj)
-
-            # if the user is in the list of users we are interested in
-            if user_id in users:
-                
-                try:
-                    # save time data
-                    spent_time_data[support_type][user_id]["firstname"] = users[user_id]['firstname']
-                    spent_time_data[support_type][user_id]["lastname"] = users[user_id]['lastname']
-                    spent_time_data[support_type][user_id]["email"] = users[user_id]['mail']
-                    spent_time_data[support_type][user_id]["total spent time"] += entry["hours"]
-
-                # if it is the first time the support type is seed
-                except TypeError:
-                    spent_time_data[support_type] = defaultdict(lambda: defaultdict(float))
-                    spent_time_data[support_type][user_id]["firstname"] = users[user_id]['firstname']
-                    spent_time_data[support_type][user_id]["lastname"] = users[user_id]['lastname']
-                    spent_time_data[support_type][user_id]["email"] = users[user_id]['mail']
-                    spent_time_data[support_type][user_id]["total spent time"] += entry["hours"]
-
-
-                # if it is the first time the support type or user is seen
-                try:
-                    spent_time_data[support_type][user_id]['spent_time'][entry["activity"]["name"]][toplevel_proj] += entry["hours"]
-                    spent_time_data[support_type][user_id]['spent_time'][entry["activity"]["name"]]["total"] += entry["hours"]
-                except TypeError:
-                    # if it is the first time the users is seen
-                    spent_time_data[support_type][user_id]['issues'] = set()
-                    spent_time_data[support_type][user_id]['spent_time'] = defaultdict(lambda: defaultdict(float))
-                    spent_time_data[support_type][user_id]['spent_time'][entry["activity"]["name"]][toplevel_proj] += entry["hours"]
-                    spent_time_data[support_type][user_id]['spent_time'][entry["activity"]["name"]]["total"] += entry["hours"]
-
-                try:
-                    spent_time_data[support_type][user_id]['issues'].add(entry['issue']['id'])
-                except:
-                    print(f"WARNING: Time entry without issue id by user '{entry['user']['name']}' in project '{entry['project']['name']}': https://projects.nbis.se/time_entries/{entry['id']}/edit")
-                    time_without_issue += entry['hours']
-                    #pdb.set_trace()
-
-
-
-                #pdb.set_trace()
-                # make sure user is defined in the percent matrix
-                if user_id not in percent_matrix_data:
-                    # predefine percent matrix data keys
-                    percent_matrix_data[user_id] = {'Support SMS': 0,
-                                                    'Support LTS': 0,
-                                                    'Centrala funkt': 0,
-                                                    'Support sysbio': 0,
-                                                    'Data mgmt': 0,
-                                                    'Human data': 0,
-                                                    'sysdev': 0,
-                                                    'Pipelines & Tools': 0,
-                                                    'SCoRe': 0,
-                                                    'Training & Nat netw': 0,
-                                                    'ELIXIR': 0,
-                                                    'BIIF': 0,
-                                                    'AIDA DH': 0,
-                                                    'Övrigt': 0,
-                                                    'total': 0,
-                                                    'user': users[user_id],
-                                                    }
-
-                # classify time for the percentage matrix
-                if (projects[toplevel_proj]['name'] == "National Bioinformatics Support" and entry['activity']['name'] in ["Support", "Consultation"]) or ():
-                    percent_matrix_data[user_id]['Support SMS'] += entry['hours']
-                    percent_matrix_data[user_id]['total'] += entry['hours']
-
-                elif projects[toplevel_proj]['name'] == "Long-term Support" and entry['activity']['name'] in ["Support", "Consultation"]:
-                    percent_matrix_data[user_id]['Support LTS'] += entry['hours']
-                    percent_matrix_data[user_id]['total'] += entry['hours']
-
-                elif entry.get('issue', {}).get('id') == 3774:
-                    percent_matrix_data[user_id]['ELIXIR'] += entry['hours']
-                    percent_matrix_data[user_id]['total'] += entry['hours']
-
-                elif entry['activity']['name'] in ["Professional Development", "Absence (Vacation/VAB/Other)", "Internal NBIS", "Administration", "Internal consultation"]:
-                    pass
-
-                elif projects[toplevel_proj]['name'] not in ["National Bioinformatics Support", "Long-term Support"] and entry['activity']['name'] in ["Consultation"]:
-                    percent_matrix_data[user_id]['Support SMS'] += entry['hours']
-                    percent_matrix_data[user_id]['total'] += entry['hours']
-
-                    percent_matrix_data[user_id]['total'] += entry['hours']
-                elif entry.get('issue', {}).get('id') in [3499, 7000] and entry['activity']['name'] in ["Consultation"]:
-                    percent_matrix_data[user_id]['Support SMS'] += entry['hours']
-                    percent_matrix_data[user_id]['total'] += entry['hours']
-
-                elif entry['activity']['name'] == "NBIS Management":
-                    percent_matrix_data[user_id]['Centrala funkt'] += entry['hours']
-                    percent_matrix_data[user_id]['total'] += entry['hours']
-
-                elif entry['activity']['name'] in ["Support (DM)", "Consultation (DM)"]:
-                    percent_matrix_data[user_id]['Data mgmt'] += entry['hours']
-                    percent_matrix_data[user_id]['total'] += entry['hours']
-
-                elif entry['activity']['name'] in ["Development"]:
-                    percent_matrix_data[user_id]['Pipelines & Tools'] += entry['hours']
-                    percent_matrix_data[user_id]['total'] += entry['hours']
-
-                elif entry['activity']['name'] in ["Training", "Outreach"]:
-                    percent_matrix_data[user_id]['Training & Nat netw'] += entry['hours']
-                    percent_matrix_data[user_id]['total'] += entry['hours']
-
-                elif projects[toplevel_proj]['name'] not in ["National Bioinformatics Support", "Long-term Support"] and entry['activity']['name'] in ["Support"]:
-                    percent_matrix_data[user_id]['Övrigt'] += entry['hours']
-                    percent_matrix_data[user_id]['total'] += entry['hours']
-
-                else:
-                    print(f"WARNING: Time entry by user '{entry['user']['name']}' in project '{entry['project']['name']}' not classified: https://projects.nbis.se/time_entries/{entry['id']}/edit")
-
-        offset += len(entries)
-        print(f"Fetched {offset} time entries")
+
+    # predefine percent matrix data keys for all users
+    percent_matrix_data = {}
+    for (user_id,) in batch.group([batch.user_ids], selected)[0]:
+        percent_matrix_data[user_id] = {'Support SMS': 0,
+                                        'Support LTS': 0,
+                                        'Centrala funkt': 0,
+                                        'Support sysbio': 0,
+                                        'Data mgmt': 0,
+                                        'Human data': 0,
+                                        'sysdev': 0,
+                                        'Pipelines & Tools': 0,
+                                        'SCoRe': 0,
+                                        'Training & Nat netw': 0,
+                                        'ELIXIR': 0,
+                                        'BIIF': 0,
+                                        'AIDA DH': 0,
+                                        'Övrigt': 0,
+                                        'total': 0,
+                                        'user': users[user_id],
+                                        }
+
+    # classify time for the percentage matrix, once per toplevel project, activity and issue used by a rule
+    issue_keys = np.where(np.isin(batch.issue_ids, list(classifier.rule_issues)), batch.issue_ids, -1)
+    rule_keys, rule_index = batch.group([toplevel_ids, batch.activity_ids, batch.activity_codes, issue_keys], selected)
+    rules = [ classifier.classify(toplevel_proj, activity_id, batch.activity_names[activity_code], issue_id if issue_id >= 0 else None)
+              for toplevel_proj, activity_id, activity_code, issue_id in rule_keys ]
+
+    # the rule and percent matrix column of each entry, -1 if there is none
+    columns      = list(dict.fromkeys( rule['column'] for rule in rules if rule and rule['column'] ))
+    entry_rules  = np.full(len(batch), -1, dtype=np.int64)
+    entry_rules[selected] = rule_index
+    rule_columns = np.array([ columns.index(rule['column']) if rule and rule['column'] else -1 for rule in rules ] + [-1], dtype=np.int64)
+    entry_columns = rule_columns[entry_rules]
+    counted       = entry_columns >= 0
+
+    for (user_id, column), hours in batch.sum_hours([batch.user_ids, entry_columns], counted).items():
+        percent_matrix_data[user_id][columns[column]] += hours
+    for (user_id,), hours in batch.sum_hours([batch.user_ids], counted).items():
+        percent_matrix_data[user_id]['total'] += hours
+
+    # keep track of how much each rule is used
+    rule_entries = np.bincount(rule_index, minlength=len(rules))
+    rule_hours   = np.bincount(rule_index, weights=batch.hours[selected], minlength=len(rules))
+    for rule, entries, hours in zip(rules, rule_entries.tolist(), rule_hours.tolist()):
+        classifier.count(rule, entries, hours)
+
+    unclassified = [ rule_num for rule_num, rule in enumerate(rules) if rule is None ]
+    for i in np.flatnonzero(selected & np.isin(entry_rules, unclassified)):
+        entry = time_entries[i]
+        print(f"WARNING: Time entry by user '{entry.user_name}' in project '{entry.project_name}' not classified: https://projects.nbis.se/time_entries/{entry.id}/edit")
 
     if time_without_issue > 0:
         print(f"WARNING: {time_without_issue} hours of time entries without issue id")
 
+    if rule_stats:
+        classifier.print_stats()
+
     return spent_time_data, percent_matrix_data
 
 
 
 
-def generate_report(spent_time_data, percent_matrix_data, args):
+def generate_report(spent_time_data, percent_matrix_data, args, redmine):
     """
     Summarize the issues as an Excel file and makes statistics as well.
 
     Args:
-        output_path (str): Path to save the Excel file.
+        args: Arguments, with the path to save the Excel file as output, and optionally values and formula_audit set.
+        redmine: Redmine_utils object, to look up project names.
     """
 
     output_path = args.output
 
+    # write computed numbers instead of formulas
+    values = getattr(args, 'values', False)
+
     # create workbook
-    workbook  = xlsxwriter.Workbook(output_path)
+    workbook  = Report_writer(output_path)
 
     # define formatting
     col_green         = "92d050" # Accent6
     col_yellow        = "ffd966" # Accent4 60%
     col_red           = "f8cbad" # Accent2 40%
-    col_blue          = "bdd7ee" # Accent5 40%
-    bold_text         = workbook.add_format({'bold': True})
-    percent           = workbook.add_format({'num_format': '0%'})
-    percent_bg_green  = workbook.add_format({'num_format': '0%', 'bg_color': col_green}) 
-    percent_bg_yellow = workbook.add_format({'num_format': '0%', 'bg_color': col_yellow})
-    percent_bg_red    = workbook.add_format({'num_format': '0%', 'bg_color': col_red})
-    percent_bg_blue   = workbook.add_format({'num_format': '0%', 'bg_color': col_blue})
-    bg_green          = workbook.add_format({'bg_color': col_green}) 
-    bg_yellow         = workbook.add_format({'bg_color': col_yellow}) 
-    bg_red            = workbook.add_format({'bg_color': col_red}) 
-    bg_blue           = workbook.add_format({'bg_color': col_blue}) 
+    bold_text         = workbook.format(bold=True)
+    percent           = workbook.format(num_format='0%')
+    percent_bg_green  = workbook.format(num_format='0%', bg_color=col_green)
+    percent_bg_yellow = workbook.format(num_format='0%', bg_color=col_yellow)
+    percent_bg_red    = workbook.format(num_format='0%', bg_color=col_red)
+    bg_yellow         = workbook.format(bg_color=col_yellow)
+    bg_red            = workbook.format(bg_color=col_red)
+
+
+    def expert_formulas(r):
+        """
+        The formulas in columns R to AT of an expert row, with r as the row number in Excel's numbering.
+        """
+
+        # sum of all activity time, and all activity time except absence
+        cells  = [f"=SUM(B{r}:Q{r})",
+                  f"=SUM(B{r}:P{r})",
+                 ]
+
+        # percentage per activity name
+        cells += [ (f"=IF(S{r}=0, 0, {col}{r}/S{r})", percent) for col in ['B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L', 'M'] ]
+        cells += [ (f"=IF(S{r}=0, 0, Q{r}/R{r})", percent),
+                   (f"=IF(@S:S=0, 0, (@B:B+@E:E+@F:F+@G:G+@H:H+@I:I+@N:N+@O:O+@P:P)/@S:S)", percent_bg_green),
+                 ]
+
+        # 2 empty columns
+        cells += ['', '']
+
+        # the Bengt report, summarize values
+        cells += [ (f"=@E:E + @H:H", bg_yellow),
+                   (f"=@F:F + @I:I", bg_yellow),
+                   (f"=@G:G", bg_yellow),
+                   ("", bg_yellow),
+                   ("", bg_yellow),
+                   ("", bg_yellow),
+                   (f"=@AH:AH + @AI:AI + @AJ:AJ + @AK:AK + @AL:AL + @AM:AM", bg_yellow),
+                 ]
+        cells += [ (f"=IF(@AN:AN=0, 0, @{col}:{col} / @AN:AN)", percent_bg_yellow) for col in ['AH', 'AI', 'AJ', 'AK', 'AL', 'AM'] ]
+
+        return cells
+
+
+
+    def expert_values(hours):
+        """
+        The values of the formulas in expert_formulas, computed from the hours per activity in columns B to Q.
+        """
+
+        # hours by column name, empty cells count as 0 like in Excel
+        h = dict(zip('BCDEFGHIJKLMNOPQ', [ hour if hour != '' else 0 for hour in hours ]))
+
+        total                = sum(h[col] for col in 'BCDEFGHIJKLMNOPQ')
+        total_except_absence = sum(h[col] for col in 'BCDEFGHIJKLMNOP')
+
+        def share(part, whole):
+            return 0 if whole == 0 else part / whole
+
+        cells  = [total, total_except_absence]
+        cells += [ (share(h[col], total_except_absence), percent) for col in 'BCDEFGHILM' ]
+        cells += [ (0 if total_except_absence == 0 else share(h['Q'], total), percent),
+                   (share(sum(h[col] for col in 'BEFGHINOP'), total_except_absence), percent_bg_green),
+                 ]
+        cells += ['', '']
+
+        # the Bengt report
+        buckets = [ h['E'] + h['H'], h['F'] + h['I'], h['G'] ]
+        cells += [ (bucket, bg_yellow) for bucket in buckets ]
+        cells += [ ("", bg_yellow) ] * 3
+        cells += [ (sum(buckets), bg_yellow) ]
+        cells += [ (share(bucket, sum(buckets)), percent_bg_yellow) for bucket in buckets + [0, 0, 0] ]
+
+        return cells
+
+
+
+    def matrix_formulas(r):
+        """
+        The formulas in columns P to AE of a row in Bengt's matrix.
+        """
+
+        cells  = [f"=SUM(B{r}:O{r})"]
+        cells += [ (f"=IF({xl_col_to_name(col_num)}{r}=0, 0, {xl_col_to_name(col_num)}{r}/P{r})", percent) for col_num in range(1, 15) ]
+        cells += [ (f"=SUM(Q{r}:AD{r})", percent) ]
+
+        return cells
+
+
+
+    def matrix_values(hours):
+        """
+        The values of the formulas in matrix_formulas, computed from the hours in columns B to O.
+        """
+
+        total   = sum(hours)
+        shares  = [ 0 if hour == 0 else hour / total for hour in hours ]
+
+        return [total] + [ (share, percent) for share in shares ] + [ (sum(shares), percent) ]
+
 
     # create info sheet
     info_sheet  = workbook.add_worksheet("Report info")
@@ -412,8 +599,8 @@ def generate_report(spent_time_data, percent_matrix_data, args):
                     'Most common Redmine project',
                     'Issues',
                   ]
-        for col_num, header in enumerate(headers):
-            sheets[support_type].write(0, col_num, header, bold_text)
+        workbook.write_row(sheets[support_type], 0, headers, bold_text)
+        expert_headers = headers
     
         # adjust column widths to fit the headers
         for i, header in enumerate(headers):
@@ -438,110 +625,39 @@ def generate_report(spent_time_data, percent_matrix_data, args):
         activity_map.update( { key:val for val,key in activity_map.items() } )
     
         # write expert stats
+        expert_rows  = []
+        expert_hours = []
         for row_num, (user_id, user) in enumerate(sorted(spent_time_data[support_type].items(), key=lambda item: item[1]['firstname']), 1):
-    
-            # init counter
-            col_num = 0
-    
+
+            # readability, the row number in Excel's numbering
+            r = row_num+1
+
             # easy one first, name
-            sheets[support_type].write(row_num, col_num, f"{user['firstname']} {user['lastname']}")
-            col_num += 1
-            
+            row = [f"{user['firstname']} {user['lastname']}"]
+
             # next up, summarize per activity name
             for activity_name in activity_names:
-    
+
                 # get the user's time the the current activity
                 user_spent_time = user.get('spent_time', {})
                 user_activity = user_spent_time.get(activity_map.get(activity_name, activity_name), {})
-    
+
                 # write out the activity's total amount of hours
-                sheets[support_type].write(row_num, col_num, user_activity.get("total", ''))
-                col_num += 1
-    
-            
-            # write formula for sum of all activity time
-            sheets[support_type].write(row_num, col_num, f"=SUM(B{row_num+1}:Q{row_num+1})")
-            col_num += 1
-    
-    
-            # write formula for sum of all activity time except absence
-            sheets[support_type].write(row_num, col_num, f"=SUM(B{row_num+1}:P{row_num+1})")
-            col_num += 1
-    
-    
-            # calculate percentage per activity name
-            sheets[support_type].write(row_num, col_num, f"=IF(S{row_num+1}=0, 0, B{row_num+1}/S{row_num+1})", percent)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(S{row_num+1}=0, 0, C{row_num+1}/S{row_num+1})", percent)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(S{row_num+1}=0, 0, D{row_num+1}/S{row_num+1})", percent)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(S{row_num+1}=0, 0, E{row_num+1}/S{row_num+1})", percent)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(S{row_num+1}=0, 0, F{row_num+1}/S{row_num+1})", percent)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(S{row_num+1}=0, 0, G{row_num+1}/S{row_num+1})", percent)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(S{row_num+1}=0, 0, H{row_num+1}/S{row_num+1})", percent)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(S{row_num+1}=0, 0, I{row_num+1}/S{row_num+1})", percent)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(S{row_num+1}=0, 0, L{row_num+1}/S{row_num+1})", percent)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(S{row_num+1}=0, 0, M{row_num+1}/S{row_num+1})", percent)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(S{row_num+1}=0, 0, Q{row_num+1}/R{row_num+1})", percent)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(@S:S=0, 0, (@B:B+@E:E+@F:F+@G:G+@H:H+@I:I+@N:N+@O:O+@P:P)/@S:S)", percent_bg_green)
-            col_num += 1
-    
-    
-            # add 2 empty columns
-            sheets[support_type].write(row_num, col_num, '')
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, '')
-            col_num += 1
-    
-    
-            # add the Bengt report
-    
-            # readability
-            n_experts = len(spent_time_data[support_type])
-    
-            # summarize values
-            sheets[support_type].write(row_num, col_num, f"=@E:E + @H:H", bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=@F:F + @I:I", bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=@G:G", bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, "", bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, "", bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, "", bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=@AH:AH + @AI:AI + @AJ:AJ + @AK:AK + @AL:AL + @AM:AM", bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(@AN:AN=0, 0, @AH:AH / @AN:AN)", percent_bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(@AN:AN=0, 0, @AI:AI / @AN:AN)", percent_bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(@AN:AN=0, 0, @AJ:AJ / @AN:AN)", percent_bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(@AN:AN=0, 0, @AK:AK / @AN:AN)", percent_bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(@AN:AN=0, 0, @AL:AL / @AN:AN)", percent_bg_yellow)
-            col_num += 1
-            sheets[support_type].write(row_num, col_num, f"=IF(@AN:AN=0, 0, @AM:AM / @AN:AN)", percent_bg_yellow)
-            col_num += 1
-    
-    
+                row.append(user_activity.get("total", ''))
+
+            # add the totals, percentages and the Bengt report
+            if values:
+                computed = expert_values(row[1:17])
+                expert_hours.append(row[1:17])
+                expert_rows.append(computed)
+                row += computed
+            else:
+                row += expert_formulas(r)
+
             # add space
-            sheets[support_type].write(row_num, col_num, '')
-            col_num += 1
-    
-    
+            row.append('')
+
+
             # calculate the most common redmine toplevel project
             proj_hour_counts = defaultdict(lambda: defaultdict(float))
             for activity,times in user['spent_time'].items():
@@ -550,56 +666,58 @@ def generate_report(spent_time_data, percent_matrix_data, args):
                     if proj_id == 'total':
                         continue
                     proj_hour_counts[proj_id] =+ time
-    
+
             # get name of most common redmine toplevel project
             most_common_redmine_project_id   = max(proj_hour_counts, key=proj_hour_counts.get)
             most_common_redmine_project_name = redmine.projects[most_common_redmine_project_id]['name']
-    
-            # print it
-            sheets[support_type].write(row_num, col_num, most_common_redmine_project_name)
-            col_num += 1
-    
-    
-            # print out all issues the exper has logged time on
-            sheets[support_type].write(row_num, col_num, ",".join(map(str, user['issues'])))
-            col_num += 1
-    
+
+            # print it, and all issues the exper has logged time on
+            row += [most_common_redmine_project_name,
+                    ",".join(map(str, user['issues'])),
+                   ]
+
+            workbook.write_row(sheets[support_type], row_num, row)
+
         ### ok, user specific data is done, now general stats
-    
+
         # reset
-        col_num  = 0
-        row_num += 1 
-    
-        # column averages
-        sheets[support_type].write(row_num, col_num, 'Average')
-        col_num = 19
-        for i in range(12):
-            col_name = xl_col_to_name(col_num+i) 
-            sheets[support_type].write(row_num, col_num+i, f"=AVERAGE({col_name}2:{col_name}{row_num})", percent_bg_red)
+        row_num += 1
+
+        # column averages, the row format is set before the row is written
         sheets[support_type].set_row(row_num, None, bg_red)
-    
-    
+        workbook.write_row(sheets[support_type], row_num, ['Average'])
+        if values:
+            workbook.write_row(sheets[support_type], row_num, [ sum(cells[2+i][0] for cells in expert_rows) / len(expert_rows) for i in range(12) ], percent_bg_red, first_col=19)
+        else:
+            workbook.write_row(sheets[support_type], row_num, [ f"=AVERAGE({xl_col_to_name(19+i)}2:{xl_col_to_name(19+i)}{row_num})" for i in range(12) ], percent_bg_red, first_col=19)
+
+
         # reset
-        col_num  = 0
-        row_num += 1 
-    
-        # column averages
+        row_num += 1
+
+        # column totals
         sheets[support_type].set_row(row_num, None, bg_red)
-        sheets[support_type].write(row_num, col_num, 'Total')
-        col_num += 1
-        for activity_name in activity_names:
-            # write out the activity's average hours spent
-            col_name = xl_col_to_name(col_num) 
-            sheets[support_type].write(row_num, col_num, f"=SUM({col_name}2:{col_name}{row_num-1})")
-            col_num += 1
-    
-        # the total columns as well
-        sheets[support_type].write(row_num, col_num, f"=SUM(R2:R{row_num-1})")
-        col_num += 1
-        sheets[support_type].write(row_num, col_num, f"=SUM(S2:S{row_num-1})")
-        col_num += 1
-    
-    
+        row = ['Total']
+        if values:
+            # the activity's total hours spent, and the total columns as well
+            row += [ sum(hours for hours in column if hours != '') for column in zip(*expert_hours) ]
+            row += [ sum(cells[0] for cells in expert_rows),
+                     sum(cells[1] for cells in expert_rows),
+                   ]
+        else:
+            for col_num, activity_name in enumerate(activity_names, 1):
+                # write out the activity's total hours spent
+                col_name = xl_col_to_name(col_num)
+                row.append(f"=SUM({col_name}2:{col_name}{row_num-1})")
+
+            # the total columns as well
+            row += [f"=SUM(R2:R{row_num-1})",
+                    f"=SUM(S2:S{row_num-1})",
+                   ]
+        workbook.write_row(sheets[support_type], row_num, row)
+
+
+
 
 
     ### Create the Bengt matrix ###
@@ -628,8 +746,7 @@ def generate_report(spent_time_data, percent_matrix_data, args):
     headers = ['Expert'] + headers_raw + ['Summa'] + [f"{header} (%)" for header in headers_raw] + ['Summa (%)']
 
     #pdb.set_trace()
-    for col_num, header in enumerate(headers):
-        summary_sheet.write(0, col_num, header, bold_text)
+    workbook.write_row(summary_sheet, 0, headers, bold_text)
 
     # adjust column widths to fit the headers
     for i, header in enumerate(headers):
@@ -642,32 +759,49 @@ def generate_report(spent_time_data, percent_matrix_data, args):
     # write expert stats
     for row_num, (user_id, user_entry) in enumerate(sorted(percent_matrix_data.items(), key=lambda item: f"{item[1]['user']['firstname']} {item[1]['user']['lastname']}"), 1):
 
-        # init counter
-        col_num = 0
+        # readability, the row number in Excel's numbering
+        r = row_num+1
 
         # easy one first, name
-        #pdb.set_trace()
-        summary_sheet.write(row_num, col_num, f"{user_entry['user']['firstname']} {user_entry['user']['lastname']}")
-        col_num += 1
+        row = [f"{user_entry['user']['firstname']} {user_entry['user']['lastname']}"]
 
         # write hours
-        for i, header in enumerate(headers_raw):
-            summary_sheet.write(row_num, col_num+i, percent_matrix_data[user_id][header])
-        col_num += len(headers_raw)
-
-        # write total hours
-        summary_sheet.write(row_num, col_num, f"=SUM(B{row_num+1}:O{row_num+1})")
-        col_num += 1
+        row += [ percent_matrix_data[user_id][header] for header in headers_raw ]
 
-        # write percentages
-        for i, header in enumerate(headers_raw):
-            summary_sheet.write(row_num, col_num+i, f"=IF({xl_col_to_name(col_num+i-len(headers_raw)-1)}{row_num+1}=0, 0, {xl_col_to_name(col_num+i-len(headers_raw)-1)}{row_num+1}/P{row_num+1})", percent)
-        col_num += len(headers_raw)
+        # write total hours, percentages and total percentage
+        if values:
+            row += matrix_values(row[1:])
+        else:
+            row += matrix_formulas(r)
 
-        # write total percentage
-        summary_sheet.write(row_num, col_num, f"=SUM(Q{row_num+1}:AD{row_num+1})", percent)
+        workbook.write_row(summary_sheet, row_num, row)
     #######################################
 
+
+    # list the formulas behind the computed columns, to be able to check the numbers
+    if getattr(args, 'formula_audit', False):
+
+        audit_sheet = workbook.add_worksheet("Formula audit")
+        workbook.write_row(audit_sheet, 0, ['Sheet', 'Column', 'Header', 'Formula (row 2)'], bold_text)
+        audit_sheet.set_column(0, 1, 15)
+        audit_sheet.set_column(2, 2, 30)
+
+        audit_rows  = [ ('Support type sheets', col_num, expert_headers[col_num], cell) for col_num, cell in enumerate(expert_formulas(2), 17) ]
+        audit_rows += [ ("Bengt's matrix",      col_num, headers[col_num],        cell) for col_num, cell in enumerate(matrix_formulas(2), 15) ]
+
+        row_num = 1
+        for sheet_name, col_num, header, cell in audit_rows:
+
+            # skip the empty columns
+            formula = cell[0] if isinstance(cell, tuple) else cell
+            if not formula:
+                continue
+
+            # write the formula as text, so it is shown instead of calculated
+            workbook.write_row(audit_sheet, row_num, [sheet_name, xl_col_to_name(col_num), header])
+            audit_sheet.write_string(row_num, 3, formula)
+            row_num += 1
+
     workbook.close()
     print(f'Statistics saved as {output_path}')
     return
@@ -685,18 +819,19 @@ if __name__ == "__main__":
         args.end_date   = f"{args.year  }-11-30"
 
     # login to redmine
-    redmine_url, api_key = load_config(args.config)
-    redmine = Redmine_utils({'api_key':api_key, 'url':redmine_url})
+    config  = load_config(args.config)
+    config.update(refresh=args.refresh, offline=args.offline, store=args.store)
+    redmine = Redmine_utils(config)
 
     # get all projects
-    projects = redmine.get_project_structure()
+    projects = redmine.projects
     
     # get group id from group name
-    group_id = get_group_id(redmine_url, api_key, args.group_name)
+    group_id = get_group_id(redmine.session, args.group_name)
 
     # get time entries withing the date range requested
     date_interval = {"<=": args.end_date, ">=": args.start_date}
-    spent_time_data, percent_matrix_data = get_time_entries(redmine_url, api_key, group_id, date_interval, redmine, projects, args.exclude_timelogbot)
+    spent_time_data, percent_matrix_data = get_time_entries(redmine.session, group_id, date_interval, redmine, projects, args.exclude_timelogbot, args.rule_stats)
 
     # write the report
-    generate_report(spent_time_data, percent_matrix_data, args)
+    generate_report(spent_time_data, percent_matrix_data, args, redmine)
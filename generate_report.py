@@ -4,14 +4,18 @@ import pdb
 from pprint import pprint
 
 import argparse
+import functools
 from argparse import RawTextHelpFormatter
-import requests
 import yaml
 import re
-import xlsxwriter
+from Report_utils import Report_writer
+import os
 import sys
 import logging
-from Redmine_utils import Redmine_utils
+import numpy as np
+import asyncio
+from Redmine_utils import Redmine_utils, Issue, Time_entry, Time_entry_batch, add_cache_arguments, get_custom_field, merge_time_entries, run_async
+import generate_bengts_report
 
 # create logger
 logging.basicConfig(
@@ -40,341 +44,502 @@ def redmine_url(type, id):
 
 
 
-def uni_shortname2longname(uni, issue_id="<not set>"):
+class Affiliation_resolver:
+    """
+    Resolves the affiliation of a project's PI from the Organization custom field and the PI e-mail,
+    using the translation, domain and override tables in affiliations.yaml.
+    """
 
-    # define translation table
-    translation = {
-        'Chalmers'                          : 'Chalmers University of Technology',
-        'KI'                                : 'Karolinska Institutet',
-        'KTH'                               : 'KTH Royal Institute of Technology',
-        'LiU'                               : 'Linköping University',
-        'LU'                                : 'Lund University',
-        'SU'                                : 'Stockholm University',
-        'SLU'                               : 'Swedish University of Agricultural Sciences',
-        'UmU'                               : 'Umeå University',
-        'GU'                                : 'University of Gothenburg',
-        'UU'                                : 'Uppsala University',
-        'NRM'                               : 'Naturhistoriska Riksmuséet',
-        'LNU'                               : 'Linnaeus University',
-        'Örebro University'                 : 'Örebro University',
-        'Other Swedish University'          : 'Other Swedish University',
-        'Other Swedish organization'        : 'Other Swedish organization',
-        'Healthcare'                        : 'Healthcare',
-        'Industry'                          : 'Industry',
-        'International University'          : 'International University',
-        'Other international organization'  : 'Other international organization',
-        'SciLifeLab'                        : None,
-        'Other'                             : None,
-        'N/A'                               : None,
-    }
+    def __init__(self, path, memo_size=4096):
+        """
+        Load the tables and normalize their keys once, so lookups are plain dict lookups.
+        """
 
-    if uni not in translation:
-        # should we look at PIs email to determin this_
-        logger.warning(f"Uni not in translation list, '{uni}' (issue: {redmine_url('issue', issue_id)})")
+        with open(path) as f:
+            tables = yaml.safe_load(f)
 
-    # return translation if it exists, otherwise return None
-    return translation.get(uni, None)
+        self.translation = { self.normalize(key): value for key, value in (tables.get('translation') or {}).items() }
+        self.domains     = { self.normalize(key): value for key, value in (tables.get('domains')     or {}).items() }
+        self.override    = { self.normalize(key): value for key, value in (tables.get('override')    or {}).items() }
 
+        # remember the outcome per (organization, email), most issues share them
+        self.lookup = functools.lru_cache(maxsize=memo_size)(self._lookup)
 
 
 
-def uni_from_pi_email(email, issue_id="<not set>"):
-    """
-    Guess the project's university based on the PIs email domain.
-    """
+    @staticmethod
+    def normalize(value):
+        """
+        Normalize an organization name or e-mail, so that case and surrounding whitespace doesn't matter.
+        """
+
+        return (value or '').strip().lower()
+
+
+
+    def _lookup(self, organization, email):
+        """
+        Resolve a normalized (organization, email) pair.
+
+        Returns the affiliation, None if it is not known, and the warnings to log for each issue with this pair.
+        The warnings are formatted with the organization and email as they are in Redmine, see resolve.
+        """
+
+        warnings = []
+
+        # translate the organization field
+        if organization not in self.translation:
+            warnings.append("Uni not in translation list, '{organization}'")
+        affiliation = self.translation.get(organization)
+
+        # if a valid affiliation was not found, try getting it through the PIs email instead
+        if affiliation or not email:
+            return affiliation, tuple(warnings)
+
+        # check if email is a special one
+        if email in self.override:
+            return self.override[email], tuple(warnings)
 
-    # email suffix geographical translation
-    domains = {
-
-    'gu'                    : 'University of Gothenburg',
-    'akademiska'            : 'Healthcare',
-    'bergianska'            : 'Stockholm University',
-    'bils'                  : 'Other Swedish University',
-    'bioinfo'               : 'Other Swedish University',
-    'broadinstitute'        : 'International University',
-    'chalmers'              : 'Chalmers University of Technology',
-    'csic'                  : 'International University',
-    'du'                    : 'Other Swedish University',
-    'foi'                   : 'Other Swedish University',
-    'folkhalsomyndigheten'  : 'Healthcare',
-#    'gmail'                 : 'Other Swedish University',
-#    'hotmail'               : 'Other Swedish University',
-    'hb'                    : 'Other Swedish University',
-    'hhs'                   : 'Other Swedish University',
-    'hig'                   : 'Other Swedish University',
-    'irfu'                  : 'Uppsala University',
-    'karolinska'            : 'Healthcare',
-    'kau'                   : 'Other Swedish University',
-    'ki'                    : 'Karolinska Institutet',
-    'kth'                   : 'KTH Royal Institute of Technology',
-    'lio'                   : 'Healthcare',
-    'liu'                   : 'Linköping University',
-    'lnu'                   : 'Other Swedish University',
-    'lth'                   : 'Lund University',
-    'ltu'                   : 'Other Swedish University',
-    'lu'                    : 'Lund University',
-    'ivl'                   : 'Other Swedish organization',
-    'ju'                    : 'Other Swedish University',
-    'mac'                   : 'Other Swedish University',
-    'mdh'                   : 'Other Swedish University',
-    'miun'                  : 'Other Swedish University',
-    'nrm'                   : 'Naturhistoriska Riksmuséet',
-    'oru'                   : 'Other Swedish University',
-    'physto'                : 'Stockholm University',
-    'regionorebrolan'       : 'Healthcare',
-    'regionostergotland'    : 'Healthcare',
-#    'scilifelab'            : 'Stockholm University',
-    'sh'                    : 'Other Swedish University',
-    'sll'                   : 'Healthcare',
-    'slu'                   : 'Swedish University of Agricultural Sciences',
-    'su'                    : 'Stockholm University',
-    'sva'                   : 'Other Swedish organization',
-    'umu'                   : 'Umeå University',
-    'uu'                    : 'Uppsala University',
-    'vgregion'              : 'Other Swedish organization',
-    'regionhalland'         : 'Healthcare',
-    'regionorebrolan'       : 'Healthcare',
-    'rjl'                   : 'Other Swedish organization',
-    'his'                   : 'Other Swedish University',
-    'ac'                    : 'International University',
-    'univ-amu'              : 'International University',
-    'usp'                   : 'International University',
-    'syonax'                : 'Stockholm University',
-    }
-
-
-    # define a list of persons who are exceptions, for addresses like scilifelab.se etc
-    override = {
-
-    'kersli@broadinstitute.org' : 'Uppsala University',
-    'afshin.ahmadian@scilifelab.se' : 'KTH Royal Institute of Technology',
-    'anders.andersson@scilifelab.se' : 'KTH Royal Institute of Technology',
-    'ann-charlotte.sonnhammer@scilifelab.se' : 'KTH Royal Institute of Technology',
-    'arne@bioinfo.se' : 'Stockholm University',
-    'bastiaan.evers@scilifelab.se' : 'Karolinska Institutet',
-    'bjorn.nystedt@scilifelab.se' : 'Uppsala University',
-    'bo.lundgren@scilifelab.se' : 'Stockholm University',
-    'ellen.sherwood@scilifelab.se' : 'Karolinska Institutet',
-    'emma.lundberg@scilifelab.se' : 'KTH Royal Institute of Technology',
-    'erik.sonnhammer@scilifelab.se' : 'Stockholm University',
-    'erikbong@mac.com' : 'Swedish University of Agricultural Sciences',
-    'fredrik.levander@bils.se' : 'Lund University',
-    'grabherr@broadinstitute.org' : 'Uppsala University',
-    'henrik.lantz@bils.se' : 'Uppsala University',
-    'jens.carlsson.lab@gmail.com' : 'Stockholm University',
-    'joakim.lundeberg@scilifelab.se' : 'KTH Royal Institute of Technology',
-    'jochen.schwenk@scilifelab.se' : 'KTH Royal Institute of Technology',
-    'johan.reimegard@scilifelab.se' : 'Uppsala University',
-    'johanna.wallenius@hhs.se' : 'Other Swedish University',
-    'klas.straat@scilifelab.se' : 'KTH Royal Institute of Technology',
-    'lars.arvestad@scilifelab.se' : 'KTH Royal Institute of Technology',
-    'lukas.kall@scilifelab.se' : 'Stockholm University',
-    'lukasz.huminiecki@scilifelab.se' : 'Karolinska Institutet',
-    'lukaszhuminieckionlypersonal@gmail.com' : 'Karolinska Institutet',
-    'majid.osman@regionostergotland.se' : 'Linköping University',
-    'marc.friedlander@scilifelab.se' : 'Stockholm University',
-    'martin.norling@bils.se' : 'Uppsala University',
-    'mathias.uhlen@scilifelab.se' : 'KTH Royal Institute of Technology',
-    'mats.nilsson@scilifelab.se' : 'Stockholm University',
-    'max.kaller@scilifelab.se' : 'Karolinska Institutet',
-    'olof.emanuelsson@scilifelab.se' : 'KTH Royal Institute of Technology',
-    'petter.brodin@scilifelab.se' : 'Karolinska Institutet',
-    'sara.light@scilifelab.se' : 'Stockholm University',
-    'silvano.garnerone@scilifelab.se' : 'Karolinska Institutet',
-    'tanja.slotte@scilifelab.se' : 'Stockholm University',
-    'thomas.svensson@scilifelab.se' : 'Karolinska Institutet',
-    'bjorn.claremar@gmail.com' : 'Uppsala University',
-    'olga.dethlefsen@bils.se' : 'Stockholm University',
-    'tanjavanharn@hotmail.com' : 'Karolinska Institutet',
-    'mikael.borg@bils.se' : 'Uppsala University',
-    'aganna@broadinstitute.org' : 'Karolinska Institutet',
-    'jingwang368@gmail.com' : 'Umeå University',
-    'eriking@stanford.edu' : 'Uppsala University', 
-    'mattias@liefvendahl.se' : 'Chalmers University of Technology', 
-    'henrik.lantz@nbis.se' : 'Uppsala University', 
-    'nieuwenhuis@bio.lmu.de' : 'Uppsala University', 
-    'olga.dethlefsen@nbis.se' : 'Stockholm University', 
-    'm.hoeppner@ikmb.uni-kiel.de' : 'Uppsala University', 
-    'david.boersma@medaustron.at' : 'Uppsala University', 
-    'fredrik.levander@nbis.se' : 'Lund University', 
-    'martin.norling@nbis.se' : 'Uppsala University', 
-    'mikael.borg@nbis.se' : 'Stockholm University', 
-    'roy.francis@nbis.se' : 'Uppsala University', 
-    'strassert@protist.eu' : 'Uppsala University', 
-    'mait@ebc.ee' : 'International University', 
-    'agata.smialowska@nbis.se' : 'Stockholm University', 
-    'lriemann@bio.ku.dk' : 'International University', 
-    'kisand@ut.ee' : 'Uppsala University',  
-    'willian.silva@evobiolab.com' : 'Uppsala University', 
-    'robin@binf.ku.dk' : 'International University', 
-    'maarit.holtta-vuori@helsinki.fi' : 'International University', 
-    'ricardo_eyre@yahoo.es' : 'International University', 
-    'caroline.callot@inra.fr' : 'International University', 
-    'albin@binf.ku.dk' : 'International University', 
-    'esko.pakarinen@utu.fi' : 'International University', 
-    'rlh@sejet.dk' : 'International University', 
-    'thomas.smol@chru-lille.fr' : 'International University', 
-    'jacques.dainat@nbis.se' : 'Uppsala University', 
-    'rasmus.agren@astrazeneca.com' : 'Other Swedish organization', 
-    'strassert@gmx.net' : 'Uppsala University', 
-    'mareschal@ovsa.fr' : 'Karolinska Institutet', 
-    'jana.biermann@outlook.com' : 'University of Gothenburg', 
-    'stefan.franzen@registercentrum.se' : 'Healthcare', 
-    'lotta.wik@olink.com' : 'Other Swedish organization', 
-    'morgane.vacher@univ-nantes.fr' : 'International University', 
-    'ricky.ansell@polisen.se' : 'Other Swedish organization', 
-    'marcin.wojewodzic@kreftregisteret.no' : 'Foreign organization', 
-    'mikk.espenberg@ut.ee' : 'International University', 
-    'moa@genagon.com' : 'Other Swedish organization', 
-    'mueller@orn.mpg.de' : 'International University', 
-    'darek.kedra@gumed.edu.pl' : 'International University', 
-    'ejvest@utu.fi' : 'International University', 
-    'mbaldwin@orn.mpg.de' : 'International University', 
-    '' : '', 
-    '' : '', 
-    '' : '', 
-    }
-
-    # check if email is a special one
-    if email in override:
-        return override[email.lower()]
-
-    # check if the domain is known
-    else:
         # make sure the email has a @ in it
         domain_split = email.split('@')
         if len(domain_split) == 1:
-            return None
+            return None, tuple(warnings)
 
         # get the 2nd last element, like uu from domain.uu.se
-        domain = domain_split[-1].split(".")[-2]
+        domain_parts = domain_split[-1].split('.')
+        if len(domain_parts) > 1 and domain_parts[-2] in self.domains:
+            return self.domains[domain_parts[-2]], tuple(warnings)
 
-        # if it is known
-        if domain in domains:
-            return domains[domain]
+        warnings.append("Issue organization not known, and PI email cannot resolve which organization it belongs to: {email}")
+        return None, tuple(warnings)
 
-        # if it is not known
-        else:
-            logger.warning(f"Issue organization not known, and PI email cannot resolve which organization it belongs to: {email} (issue: {redmine_url('issue', issue_id)})")
-            return None
 
 
+    def resolve(self, organization, email=None, issue_id="<not set>"):
+        """
+        Resolve the affiliation from the organization field, falling back on the PI email if it is given.
+        """
+
+        affiliation, warnings = self.lookup(self.normalize(organization), self.normalize(email))
+
+        # show the values as they are in Redmine, so that the issue is easy to find and fix
+        for warning in warnings:
+            logger.warning(f"{warning.format(organization=organization, email=email)} (issue: {redmine_url('issue', issue_id)})")
+
+        return affiliation
+
+
+
+    def resolve_issues(self, issues, emails=None, use_email=True):
+        """
+        Resolve the affiliation of all issues at once.
+
+        Args:
+            issues (list): Issue records.
+            emails (dict): PI e-mails to use instead of the 'PI e-mail' field, by issue id.
+            use_email (bool): Fall back on the PI e-mail if the organization field doesn't tell the affiliation.
+
+        Returns:
+            dict: The affiliation, None if it is not known, by issue id.
+        """
+
+        emails = emails or {}
+
+        return { issue.id: self.resolve(get_custom_field(issue, 'Organization'),
+                                        emails.get(issue.id, get_custom_field(issue, 'PI e-mail')) if use_email else None,
+                                        issue.id)
+                 for issue in issues }
 
 
 
-def fetch_time_entries(args, url, api_key):
+# the affiliation tables are loaded once, when the script starts
+affiliations = Affiliation_resolver(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'affiliations.yaml'))
+
+
+
+
+
+def fetch_time_entries(args, session, project_ids, redmine_projects, activity_ids=None):
     """
-    Fetches the time entries within the specified date range and project ID.
+    Fetches the time entries within the specified date range and summarizes them per issue.
+
+    The issues of the time entries are fetched while the time entries are still being downloaded.
 
     Args:
-        start_date (str): Start date in format 'YYYY-MM-DD'.
-        end_date (str): End date in format 'YYYY-MM-DD'.
-        project_id (int): Project ID.
-        url (str): Redmine URL.
-        api_key (str): Redmine API key.
+        args (Namespace): Arguments with start_date, end_date, recursive and activity_filter set.
+        session (Redmine_session): Shared Redmine session.
+        project_ids (list): Ids of the root projects to fetch time entries for.
+        redmine_projects (dict): Redmine project structure.
+        activity_ids (list): Ids of the activities to fetch, None to filter on activity names instead.
 
     Returns:
-        set: Set of unique issue IDs.
+        tuple: Hours spent per activity, per issue id, and the issues by issue id, for fetch_issue_details.
     """
-    params = {
-        'key': api_key,
-        'spent_on': f'><{args.start_date}|{args.end_date}',
-#        'project_id': project_id,
-        'limit': 100,
-        'offset': 0
-    }
-    issue_ids = nested_dict()
 
-    response = requests.get(f'{url}/time_entries.json', params=params)
-    response.raise_for_status()
-    data = response.json()
+    time_entries, fetched_issues = get_time_entries(args, session, project_ids, redmine_projects, activity_ids, prefetch_issues=True)
+
+    # only match activity names if Redmine could not filter them
+    return aggregate_time_entries(args, time_entries, match_activity_names=not activity_ids), fetched_issues
+
+
+
+def get_time_entries(args, session, project_ids, redmine_projects, activity_ids=None, prefetch_issues=False):
+    """
+    Fetches the time entries within the specified date range, for the requested projects.
+
+    One query per month is sent per root project, letting Redmine include the subprojects
+    if --recursive is set, and the queries are run concurrently.
+
+    With prefetch_issues, the issue ids of each page of time entries are queued as soon as the page arrives,
+    and their issues are fetched in batches while the remaining pages are downloaded.
+
+    Args:
+        args (Namespace): Arguments with start_date, end_date and recursive set.
+        session (Redmine_session): Shared Redmine session.
+        project_ids (list): Ids of the root projects to fetch time entries for.
+        redmine_projects (dict): Redmine project structure.
+        activity_ids (list): Ids of the activities to fetch, None to fetch all activities.
+        prefetch_issues (bool): Also fetch the issues of the time entries.
+
+    Returns:
+        list: The time entries as Time_entry records, without duplicates.
+              With prefetch_issues, a tuple of the list and the issues by issue id.
+    """
+
+    # with --recursive, projects under another requested project are already covered by that one
+    project_ids = set(project_ids)
+    if args.recursive:
+        project_ids = { project_id for project_id in project_ids if not any(project_id in redmine_projects[other].get('children', set()) for other in project_ids) }
+
+    # issues are only needed for entries that will be counted, see aggregate_time_entries
+    def is_counted(entry):
+        return entry.issue_id is not None and (activity_ids or not args.activity_filter or any(word in entry.activity_name for word in args.activity_filter))
+
+    async def fetch_project_time_entries(redmine, project_id, issue_queue):
+        """
+        Fetch all time entries of a single root project, queueing the issue ids of each page if there is a queue.
+        """
+
+        params = {
+            'project_id': project_id,
+            'subproject_id': '*' if args.recursive else '!*',
+        }
+
+        # let Redmine filter on activity if the filter could be resolved to ids
+        if activity_ids:
+            params['activity_id'] = '|'.join(map(str, activity_ids))
+
+        time_entries = []
+
+        # Fetch time entries in batches, one shard per month
+        async for data in redmine.get_time_entries(args.start_date, args.end_date, params):
+
+            page = list(map(Time_entry, data['time_entries']))
+            time_entries.extend(page)
 
-    total_count = data['total_count']
+            # let the issues be fetched while the next pages are downloaded
+            if issue_queue is not None:
+                issue_queue.put_nowait([ entry.issue_id for entry in page if is_counted(entry) ])
 
-    # Fetch time entries in batches
-    while params['offset'] < total_count:
-        response = requests.get(f'{url}/time_entries.json', params=params)
-        response.raise_for_status()
-        data = response.json()
+            # Calculate progress percentage
+            progress = len(time_entries) / max(data['total_count'], 1) * 100
+            print(f'Fetching time entries ({redmine_projects[project_id]["name"]}): {progress:.2f}% complete               ', end='\r')
 
-        time_entries = data['time_entries']
+        return time_entries
 
-        for entry in time_entries:
+
+    async def fetch_all_time_entries(redmine):
+        """
+        Fetch the time entries of all root projects at the same time, and their issues if prefetch_issues is set.
+        """
+
+        if not prefetch_issues:
+            return await asyncio.gather(*[ fetch_project_time_entries(redmine, project_id, None) for project_id in project_ids ]), None
+
+        issue_queue = asyncio.Queue()
+
+        async def produce():
             try:
-                issue_ids[entry['issue']['id']][entry['activity']['name']] += entry['hours']
+                return await asyncio.gather(*[ fetch_project_time_entries(redmine, project_id, issue_queue) for project_id in project_ids ])
+            finally:
+                # tell the consumer there are no more issue ids
+                issue_queue.put_nowait(None)
 
-            except:
-                try:
-                    issue_ids[entry['issue']['id']][entry['activity']['name']] = entry['hours']
-                except Exception as e:
-                    logger.debug(f"Time entry not tied to issue: {redmine_url('time_entry', entry['id'])}")
+        time_entry_lists, issues = await asyncio.gather(produce(), redmine.get_queued_issues(issue_queue))
+        return time_entry_lists, { issue['id']: Issue(issue) for issue in issues }
 
-        params['offset'] += params['limit']
 
-        # Calculate progress percentage
-        progress = min(params['offset'], total_count) / total_count * 100
-        print(f'Fetching time entries: {progress:.2f}% complete               ', end='\r')
+    # read the time entries from the local store, if it is used
+    fetched_issues = None
+    if session.store:
+        store_project_ids = set(project_ids)
+        if args.recursive:
+            for project_id in project_ids:
+                store_project_ids.update(redmine_projects[project_id].get('children', set()))
+        time_entry_lists = [ map(Time_entry, session.get_stored_time_entries(args.start_date, args.end_date, store_project_ids, activity_ids=activity_ids)) ]
+
+    # otherwise fetch them from Redmine, one query per project
+    else:
+        time_entry_lists, fetched_issues = run_async(session, fetch_all_time_entries)
+
+    # don't return entries returned by more than one query twice
+    time_entries = merge_time_entries(time_entry_lists)
 
     print('Fetching time entries: 100% complete                               ')
-    
+
+    if not prefetch_issues:
+        return time_entries
+
+    # the local store has no issues, fetch them now
+    if fetched_issues is None:
+        fetched_issues = fetch_issues({ entry.issue_id for entry in time_entries if is_counted(entry) }, session)
+    else:
+        print(f'Fetching issue details: {len(fetched_issues)} issues fetched along with the time entries')
+
+    return time_entries, fetched_issues
+
+
+
+def get_all_time_entries(args, session):
+    """
+    Fetches all time entries within the specified date range, in all projects.
+
+    Args:
+        args (Namespace): Arguments with start_date and end_date set.
+        session (Redmine_session): Shared Redmine session.
+
+    Returns:
+        list: The time entries as Time_entry records.
+    """
+
+    # read the time entries from the local store, if it is used
+    if session.store:
+        return list(map(Time_entry, session.get_stored_time_entries(args.start_date, args.end_date)))
+
+    async def fetch_all_time_entries(redmine):
+        """
+        Fetch the time entries of all projects, in batches.
+        """
+
+        time_entries = []
+        async for data in redmine.get_time_entries(args.start_date, args.end_date):
+
+            time_entries.extend(map(Time_entry, data['time_entries']))
+
+            # Calculate progress percentage
+            progress = len(time_entries) / max(data['total_count'], 1) * 100
+            print(f'Fetching time entries: {progress:.2f}% complete               ', end='\r')
+
+        return time_entries
+
+    # the months are fetched at the same time, put the entries back in order
+    time_entries = merge_time_entries([ run_async(session, fetch_all_time_entries) ])
+
+    print('Fetching time entries: 100% complete                               ')
+
+    return time_entries
+
+
+
+def aggregate_time_entries(args, time_entries, project_filter=None, match_activity_names=True):
+    """
+    Summarizes time entries per issue and activity.
+
+    Args:
+        args (Namespace): Arguments with activity_filter set.
+        time_entries (list): Time_entry records.
+        project_filter (set): Only include time entries in these projects, None to include all.
+        match_activity_names (bool): Only include time entries with a word in --activity-filter in their activity name.
+
+    Returns:
+        dict: Hours spent per activity, per issue id.
+    """
+
+    # decode the time entries into columns
+    batch    = Time_entry_batch(time_entries)
+    selected = np.ones(len(batch), dtype=bool)
+
+    # skip entries in other projects
+    if project_filter is not None:
+        selected &= np.isin(batch.project_ids, list(project_filter))
+
+    # fall back to matching activity names if Redmine could not filter them
+    if match_activity_names and args.activity_filter:
+        matching_codes = [ code for code, name in enumerate(batch.activity_names) if any(word in name for word in args.activity_filter) ]
+        selected &= np.isin(batch.activity_codes, matching_codes)
+
+    for entry_id in batch.ids[selected & (batch.issue_ids < 0)]:
+        logger.debug(f"Time entry not tied to issue: {redmine_url('time_entry', entry_id)}")
+    selected &= batch.issue_ids >= 0
+
+    # sum the hours per issue and activity
+    issue_ids = nested_dict()
+    for (issue_id, activity_code), hours in batch.sum_hours([batch.issue_ids, batch.activity_codes], selected).items():
+        issue_ids[issue_id][batch.activity_names[activity_code]] = hours
+
     return issue_ids
 
-def fetch_issue_details(issue_ids, url, api_key, project_filter):
+def resolve_activity_filter(args, redmine):
+    """
+    Converts the words in --activity-filter to the ids of all activities with any of the words in their name.
+
+    Returns None if there is no filter, or if a word doesn't match any active activity
+    (e.g. a disabled one), in which case the names of the fetched time entries are matched instead.
+    """
+
+    if not args.activity_filter:
+        return None
+
+    activities   = redmine.get_activities()
+    activity_ids = []
+
+    for word in args.activity_filter:
+
+        matching_ids = [ activity_id for activity_id, name in activities.items() if word in name ]
+
+        # let the time entries be filtered on name instead
+        if not matching_ids:
+            logger.info(f'Activity filter "{word}" matches no active activity, filtering the time entries on activity names instead.')
+            return None
+
+        activity_ids += [ activity_id for activity_id in matching_ids if activity_id not in activity_ids ]
+
+    logger.info(f"Only fetching time logged in the activities: {', '.join(activities[activity_id] for activity_id in activity_ids)}")
+    return activity_ids
+
+
+
+def fetch_issue_details(issue_ids, session, project_filter, fetched_issues=None):
     """
     Fetches the detailed information about each issue.
 
     Args:
-        issue_ids (set): Set of unique issue IDs.
-        url (str): Redmine URL.
-        api_key (str): Redmine API key.
+        issue_ids (dict): Hours spent per activity, per issue id.
+        session (Redmine_session): Shared Redmine session.
+        project_filter (set): Only include issues in these projects.
+        fetched_issues (dict): Issues already fetched by fetch_issues, to avoid fetching them again.
 
     Returns:
         list: List of issue details.
     """
     issue_details = []
 
-    for i, issue_id in enumerate(issue_ids, 1):
-        response = requests.get(f'{url}/issues/{issue_id}.json', params={'key': api_key})
-        response.raise_for_status()
-        data = response.json()
+    if fetched_issues is None:
+        fetched_issues = fetch_issues(issue_ids, session)
+
+    for issue_id in issue_ids:
 
-        # Calculate progress percentage
-        progress = i / len(issue_ids) * 100
-        print(f'Fetching issue details: {progress:.2f}%                ', end='\r')
+        # issues that are deleted or not visible are not returned
+        if issue_id not in fetched_issues:
+            logger.warning(f"Issue could not be fetched: {redmine_url('issue', issue_id)}")
+            continue
 
 #        # skip projects from the wrong trackers
-#        if data['issue']['tracker'] not in ['Support']:
+#        if issue['tracker'] not in ['Support']:
 
-        # skip issues from other projects than defined below#        if data['issue'] ['project']['name'] not in ['National Bioinformatics Support', ] and not re.search('^Round ', data['issue'] ['project']['name']):
         # filter out everything not in the requested filter list
-        #pdb.set_trace()
-        if data['issue'] ['project']['id'] not in project_filter:
+        if fetched_issues[issue_id].project_id not in project_filter:
             continue
-       
-        data['issue']['spent_per_activity'] = dict(issue_ids[issue_id])
-        issue_details.append(data['issue'])
 
+        # re-attach the time spent per activity from the time entries, on a copy since
+        # the same fetched issue can be used by several reports
+        issue = fetched_issues[issue_id].copy(spent_per_activity=dict(issue_ids[issue_id]))
+        issue_details.append(issue)
+
+    return issue_details
+
+
+
+def fetch_issues(issue_ids, session):
+    """
+    Fetches issues in batches.
+
+    Args:
+        issue_ids (iterable): Issue ids to fetch.
+        session (Redmine_session): Shared Redmine session.
+
+    Returns:
+        dict: The issues, by issue id.
+    """
+
+    issue_ids = list(issue_ids)
+
+    async def fetch_all_issues(redmine):
+        """
+        Fetch the issues in batches, and index them by id as compact records.
+        """
+
+        fetched_issues = {}
+        async for issues in redmine.get_issues(issue_ids):
+            for issue in issues:
+                fetched_issues[issue['id']] = Issue(issue)
+
+            # Calculate progress percentage
+            progress = len(fetched_issues) / max(len(issue_ids), 1) * 100
+            print(f'Fetching issue details: {progress:.2f}%                ', end='\r')
+
+        return fetched_issues
+
+    fetched_issues = run_async(session, fetch_all_issues)
 
     print('Fetching issue details: 100%                    ')
 
-    return issue_details
+    return fetched_issues
+
+
 
 
 
+def write_count_sheet(workbook, sheet_name, label, title, values):
+    """
+    Writes a sheet with the number of projects per value, sorted by count like the formula version, and a pie chart of exactly the rows written.
 
+    Args:
+        workbook (Report_writer): The workbook to add the sheet to.
+        sheet_name (str): Name of the sheet.
+        label (str): Header of the value column.
+        title (str): Title of the chart.
+        values (list): The value of each project, empty values are counted as "Not set".
+    """
 
-def get_custom_field(issue, field_name):
+    # count the projects per value, in the order the values are first seen
+    counts = {}
+    for value in values:
+        value = value if value not in (None, '') else 'Not set'
+        counts[value] = counts.get(value, 0) + 1
 
+    sheet     = workbook.add_worksheet(sheet_name)
+    bold_text = workbook.format(bold=True)
 
-    # get field value
-    field_value = [ field['value'] for field in issue['custom_fields'] if field['name']==field_name ]
-    if len(field_value) > 0:
-        field_value = field_value[0]
-    else:
-        field_value = ''
+    # print headers and the counts, sorted on count
+    workbook.write_row(sheet, 0, [label, "#"], bold_text)
+    for row_num, (value, count) in enumerate(sorted(counts.items(), key=lambda item: item[1]), 1):
+        workbook.write_row(sheet, row_num, [value, count])
+
+    # no chart without data
+    if not counts:
+        return
+
+    # create pie chart
+    chart = workbook.add_chart({'type': 'pie'})
+
+    # add data series
+    #[sheetname, first_row, first_col, last_row, last_col].
+    chart.add_series({
+        'name'       : '# projects',
+        'categories' : [sheet_name, 1, 0, len(counts), 0],
+        'values'     : [sheet_name, 1, 1, len(counts), 1],
+        "data_labels": {"category": True, 'position': 'outside_end'}
+    })
 
-    return field_value
+    # tweak the chart
+    chart.set_title({'name': title})
+    chart.set_legend({'position': 'none'})
+    chart.set_size({'x_scale': 1.5, 'y_scale': 2})
+    chart.set_style(10)
 
+    # insert the chart
+    sheet.insert_chart('E2', chart)
 
 
 
@@ -388,30 +553,29 @@ def generate_vr_report(args, issue_details, output_path):
     """
 
     # create workbook and the info sheet
-    workbook  = xlsxwriter.Workbook(output_path)
+    workbook  = Report_writer(output_path)
     info_sheet  = workbook.add_worksheet("Report info")
 
     # create project list sheet
     pl_sheet  = workbook.add_worksheet("Project list")
     pl_sheet.activate()
-    bold_text = workbook.add_format({'bold': True})
+    bold_text = workbook.format(bold=True)
 
     # print metadata
-    info_sheet.write("A1", "General info", bold_text)
-    info_sheet.write("A2", "Start date:")
-    info_sheet.write("B2", args.start_date)
-    info_sheet.write("A3", "End date:")
-    info_sheet.write("B3", args.end_date)
-    info_sheet.write("A4", "Redmine projects:")
-    info_sheet.write("B4", ", ".join(args.project_id))
+    workbook.write_row(info_sheet, 0, ["General info"], bold_text)
+    workbook.write_row(info_sheet, 1, ["Start date:", args.start_date])
+    workbook.write_row(info_sheet, 2, ["End date:", args.end_date])
+    workbook.write_row(info_sheet, 3, ["Redmine projects:", ", ".join(args.project_id)])
 
 
     # write headers
     headers = ['Project ID', 'PI first name', 'PI last name', 'email', 'Organization', 'SCB Subject Code', 'Sex', 'Tracker', 'LTS project ID', 'Publications', 'Funding', 'Spent time this period', 'Spent time total']
-    for col_num, header in enumerate(headers):
-        pl_sheet.write(0, col_num, header, bold_text)
+    workbook.write_row(pl_sheet, 0, headers, bold_text)
 
 
+    # translate the organizations of all issues
+    pi_affiliations = affiliations.resolve_issues(issue_details, use_email=False)
+
     # write data rows
     for row_num, issue in enumerate(issue_details, 1):
 
@@ -435,24 +599,25 @@ def generate_vr_report(args, issue_details, output_path):
 
 
         # summarize the hours spent the requested period
-        time_spent_this_period = sum([ hours for hours in issue['spent_per_activity'].values() ])
+        time_spent_this_period = sum([ hours for hours in issue.spent_per_activity.values() ])
 
         #pdb.set_trace()
 
         # print values
-        pl_sheet.write(row_num, 0,  issue.get('id',''))
-        pl_sheet.write(row_num, 1,  pi_first_name)
-        pl_sheet.write(row_num, 2,  pi_last_name)
-        pl_sheet.write(row_num, 3,  get_custom_field(issue, 'PI e-mail'))
-        pl_sheet.write(row_num, 4,  uni_shortname2longname(get_custom_field(issue, 'Organization')))
-        pl_sheet.write(row_num, 5,  get_custom_field(issue, 'SCB Subject Code'))
-        pl_sheet.write(row_num, 6,  get_custom_field(issue, 'PI Gender'))
-        pl_sheet.write(row_num, 7,  issue.get('tracker',{}).get('name',''))
-        pl_sheet.write(row_num, 8,  get_custom_field(issue, 'WABI ID'))
-        pl_sheet.write(row_num, 9,  get_custom_field(issue, 'Publication(s)'))
-        pl_sheet.write(row_num, 10, get_custom_field(issue, 'Funding'))
-        pl_sheet.write(row_num, 11, time_spent_this_period)
-        pl_sheet.write(row_num, 12, issue.get('spent_hours',''))
+        workbook.write_row(pl_sheet, row_num, [ issue.id,
+                                                pi_first_name,
+                                                pi_last_name,
+                                                get_custom_field(issue, 'PI e-mail'),
+                                                pi_affiliations[issue.id],
+                                                get_custom_field(issue, 'SCB Subject Code'),
+                                                get_custom_field(issue, 'PI Gender'),
+                                                issue.tracker,
+                                                get_custom_field(issue, 'WABI ID'),
+                                                get_custom_field(issue, 'Publication(s)'),
+                                                get_custom_field(issue, 'Funding'),
+                                                time_spent_this_period,
+                                                issue.spent_hours,
+                                              ])
 
 
 
@@ -462,28 +627,26 @@ def generate_vr_report(args, issue_details, output_path):
 
     ### do other statistics
 
-    # PIs per uni
-    if 1:
+    # PIs per uni, counted by Excel formulas
+    if not args.static_stats:
         ppo_sheet = workbook.add_worksheet("Projects per org")
 
         # print headers
-        ppo_sheet.write(f"A1", "Organization", bold_text)
-        ppo_sheet.write(f"B1", "#", bold_text)
+        workbook.write_row(ppo_sheet, 0, ["Organization", "#"], bold_text)
 
         # print the UNIQUE function to get all org names
         ppo_sheet.write(f'Y1', "Raw unsorted data for the plot, don't touch.")
         ppo_sheet.write(f"Y2", "=UNIQUE('Project list'!$E$2:'Project list'!$E$10000)") # how to get rid of the 0 0 ?
 
+        # create a sorted range for the pie chart, before moving on from row 2 since the rows are written in order
+        ppo_sheet.write('A2', f"=SORT(Y2:Z10000, 2)") # how to get rid of the spill over range filled with 0?
+
         # print the counting function
         for row_num in range(2,200):
 
             # for each row, print the number of occurences in the project list of the corresponding organization name, only if there is a org name on the current row
             ppo_sheet.write(f"Z{row_num}", f"=IF( ISBLANK(Y{row_num}), \"\", COUNTIF('Project list'!$E$2:'Project list'!$E$1000, Y{row_num}))")
 
-
-        # create a sorted range for the pie chart
-        ppo_sheet.write('A2', f"=SORT(Y2:Z10000, 2)") # how to get rid of the spill over range filled with 0?
-
         # create pie chart
         ppo_chart = workbook.add_chart({'type': 'pie'})
 
@@ -532,6 +695,16 @@ def generate_vr_report(args, issue_details, output_path):
 
 
 
+    # count the projects per organization, sex, SCB subject code and tracker here instead
+    else:
+        write_count_sheet(workbook, "Projects per org",     "Organization",     "Projects per organization",     [ pi_affiliations[issue.id] for issue in issue_details ])
+        write_count_sheet(workbook, "Projects per sex",     "Sex",              "Projects per sex",              [ get_custom_field(issue, 'PI Gender') for issue in issue_details ])
+        write_count_sheet(workbook, "Projects per SCB code", "SCB Subject Code", "Projects per SCB subject code", [ get_custom_field(issue, 'SCB Subject Code') for issue in issue_details ])
+        write_count_sheet(workbook, "Projects per tracker", "Tracker",          "Projects per tracker",          [ issue.tracker for issue in issue_details ])
+
+
+
+
     workbook.close()
     print(f'Statistics saved as {output_path}')
 
@@ -568,29 +741,17 @@ def generate_sll_report(issue_details, project_id, start_date, end_date, output_
     n_pis     = set()
 
     # create workbook and the info sheet
-    workbook  = xlsxwriter.Workbook(output_path)
+    workbook  = Report_writer(output_path)
     info_sheet  = workbook.add_worksheet("Report info")
 
     # create project list sheet
     pl_sheet  = workbook.add_worksheet("PI list")
     pl_sheet.activate()
-    bold_text = workbook.add_format({'bold': True})
+    bold_text = workbook.format(bold=True)
 
     # create raw data sheet
     rd_sheet  = workbook.add_worksheet("Raw data")
-    rd_sheet.write("A1","Project ID", bold_text)
-    rd_sheet.write("B1","LTS project ID", bold_text)
-    rd_sheet.write("C1","PI first name", bold_text)
-    rd_sheet.write("D1","PI last name", bold_text)
-    rd_sheet.write("E1","PI email", bold_text)
-    rd_sheet.write("F1","Organization", bold_text)
-    rd_sheet.write("G1","SBC subject code", bold_text)
-    rd_sheet.write("H1","Sex", bold_text)
-    rd_sheet.write("I1","Type", bold_text)
-    rd_sheet.write("J1","Consortium", bold_text)
-    rd_sheet.write("K1","Spent hours this period", bold_text)
-    rd_sheet.write("L1","Redmine project", bold_text)
-    rd_sheet.write("M1","PI identifier", bold_text)
+    workbook.write_row(rd_sheet, 0, ["Project ID", "LTS project ID", "PI first name", "PI last name", "PI email", "Organization", "SBC subject code", "Sex", "Type", "Consortium", "Spent hours this period", "Redmine project", "PI identifier"], bold_text)
 
 
     # create a email to name translation table
@@ -616,26 +777,24 @@ def generate_sll_report(issue_details, project_id, start_date, end_date, output_
 
 
 
+        # readability
+        pi_email     = get_custom_field(issue, 'PI e-mail')
+        pi_name      = get_custom_field(issue, 'Principal Investigator')
+        organization = get_custom_field(issue, 'Organization')
+
         # count stuff
-        if issue['tracker']['name'] in ['Support', 'Task', 'Partner Project'] :
+        if issue.tracker in ['Support', 'Task', 'Partner Project'] :
             n_active  += 1
-            pi_email = get_custom_field(issue, 'PI e-mail')
             if pi_email:
                 n_pis.add(pi_email.lower())
             else:
                 # we still want to count something
-                n_pis.add(get_custom_field(issue, 'Principal Investigator'))
+                n_pis.add(pi_name)
 
 
-        elif issue['tracker']['name'] == 'Consultation':
+        elif issue.tracker == 'Consultation':
             n_consult += 1
 
-        # readability
-        pi_email = get_custom_field(issue, 'PI e-mail')
-
-        # get PI first and last name
-        pi_name       = get_custom_field(issue, 'Principal Investigator')
-
         # catch None PIs
         if not pi_name:
             pi_name = ''
@@ -658,30 +817,19 @@ def generate_sll_report(issue_details, project_id, start_date, end_date, output_
                     pi_email = pi_name.lower()
                 else:
                     # use the issue name instead
-                    pi_email = issue['subject']
+                    pi_email = issue.subject
 
         # summarize the hours spent the requested period
-        time_spent_this_period = sum([ hours for hours in issue['spent_per_activity'].values() ])
-
-        # get PI affiliation
-        pi_affiliation = uni_shortname2longname(get_custom_field(issue, 'Organization'), issue['id'])
+        time_spent_this_period = sum([ hours for hours in issue.spent_per_activity.values() ])
 
-        # if a valid affiliation was not found, try getting it through the PIs email instead
-        if not pi_affiliation:
-
-            # check that there is an email and try to get affiliation from that
-            if pi_email:
-                pi_affiliation = uni_from_pi_email(pi_email, issue['id'])
-
-            # if it was still not found
-            if not pi_affiliation:
-                pi_affiliation = ''
+        # get PI affiliation, through the PIs email if the organization doesn't tell it
+        pi_affiliation = affiliations.resolve(organization, pi_email, issue.id) or ''
 
         # if affiliation is other, specify it
         pi_affiliation_details = ''
         if pi_affiliation in ['Other Swedish University', 'International University', 'Healthcare', 'Industry', 'Other Swedish organization', 'Other international organization', '']:
             # get organization name
-            pi_affiliation_details = get_custom_field(issue, 'Organization') 
+            pi_affiliation_details = organization
             if pi_affiliation_details == '' or pi_affiliation_details == 'Other':
 
                 # set details to PI email url if organization is not known
@@ -702,29 +850,30 @@ def generate_sll_report(issue_details, project_id, start_date, end_date, output_
                                     }
 
         # convert the tracker name to a type that matches the rest of the reporting
-        issue['report_type'] = issue['tracker']['name']
-        if issue['project']['name'] == 'Bioimage Informatics':
-            issue['report_type'] = 'BIIF'
-        elif re.match(r'Round \d{4}-\d+', issue['project']['name']):
-            issue['report_type'] = 'LTS'
-        if issue['tracker']['name'] == 'Partner Project':
-            issue['report_type'] = 'PP'
-
-
-        # print raw data
-        rd_sheet.write(f"A{i}", issue['id'])
-        rd_sheet.write(f"B{i}", get_custom_field(issue, 'WABI ID'))
-        rd_sheet.write(f"C{i}", pi_first_name)
-        rd_sheet.write(f"D{i}", pi_last_name)
-        rd_sheet.write(f"E{i}", pi_email)
-        rd_sheet.write(f"F{i}", pi_affiliation)
-        rd_sheet.write(f"G{i}", get_custom_field(issue, 'SCB Subject Code'))
-        rd_sheet.write(f"H{i}", get_custom_field(issue, 'PI Gender'))
-        rd_sheet.write(f"I{i}", issue['report_type'])
-        rd_sheet.write(f"J{i}", consortium_members.get(pi_affiliation, 0))
-        rd_sheet.write(f"K{i}", sum([ hours for hours in issue['spent_per_activity'].values() ]))
-        rd_sheet.write(f"L{i}", issue['project']['name'])
-        rd_sheet.write(f"M{i}", pi_email.lower())
+        issue.report_type = issue.tracker
+        if issue.project_name == 'Bioimage Informatics':
+            issue.report_type = 'BIIF'
+        elif re.match(r'Round \d{4}-\d+', issue.project_name):
+            issue.report_type = 'LTS'
+        if issue.tracker == 'Partner Project':
+            issue.report_type = 'PP'
+
+
+        # print raw data, row i in Excel's numbering
+        workbook.write_row(rd_sheet, i-1, [ issue.id,
+                                            get_custom_field(issue, 'WABI ID'),
+                                            pi_first_name,
+                                            pi_last_name,
+                                            pi_email,
+                                            pi_affiliation,
+                                            get_custom_field(issue, 'SCB Subject Code'),
+                                            get_custom_field(issue, 'PI Gender'),
+                                            issue.report_type,
+                                            consortium_members.get(pi_affiliation, 0),
+                                            time_spent_this_period,
+                                            issue.project_name,
+                                            pi_email.lower(),
+                                          ])
 
 
 
@@ -734,37 +883,25 @@ def generate_sll_report(issue_details, project_id, start_date, end_date, output_
 
 
     # print metadata
-    info_sheet.write("A1", "General info", bold_text)
-    info_sheet.write("A2", "Start date:")
-    info_sheet.write("B2", start_date)
-    info_sheet.write("A3", "End date:")
-    info_sheet.write("B3", end_date)
-    info_sheet.write("A4", "Redmine projects:")
-    info_sheet.write("B4", ", ".join(project_id))
-    info_sheet.write("A6", "Active support projects:")
-    info_sheet.write("B6", n_active)
-    info_sheet.write("A7", "Booked consultations:")
-    info_sheet.write("B7", n_consult)
-    info_sheet.write("A8", "Unique PIs (ex. consultations):")
-    info_sheet.write("B8", len(n_pis))
+    workbook.write_row(info_sheet, 0, ["General info"], bold_text)
+    workbook.write_row(info_sheet, 1, ["Start date:", start_date])
+    workbook.write_row(info_sheet, 2, ["End date:", end_date])
+    workbook.write_row(info_sheet, 3, ["Redmine projects:", ", ".join(project_id)])
+    workbook.write_row(info_sheet, 5, ["Active support projects:", n_active])
+    workbook.write_row(info_sheet, 6, ["Booked consultations:", n_consult])
+    workbook.write_row(info_sheet, 7, ["Unique PIs (ex. consultations):", len(n_pis)])
 
 
     # write headers
     headers = ['PI first name', 'PI last name', 'PI e-mail', 'Affiliation', 'Non-specific affiliation', 'Time spent this period']
-    for col_num, header in enumerate(headers):
-        pl_sheet.write(0, col_num, header, bold_text)
+    workbook.write_row(pl_sheet, 0, headers, bold_text)
 
 
     # write data rows
     for row_num, pi in enumerate(pis.values(), 1):
 
         # print values
-        pl_sheet.write(row_num, 0,  pi['pi_first_name'])
-        pl_sheet.write(row_num, 1,  pi['pi_last_name'])
-        pl_sheet.write(row_num, 2,  pi['pi_email'])
-        pl_sheet.write(row_num, 3,  pi['pi_affiliation'])
-        pl_sheet.write(row_num, 4,  pi['pi_affiliation_details'])
-        pl_sheet.write(row_num, 5,  pi['time_spent'])
+        workbook.write_row(pl_sheet, row_num, [ pi['pi_first_name'], pi['pi_last_name'], pi['pi_email'], pi['pi_affiliation'], pi['pi_affiliation_details'], pi['time_spent'] ])
 
 
 
@@ -779,23 +916,21 @@ def generate_sll_report(issue_details, project_id, start_date, end_date, output_
         ppo_sheet = workbook.add_worksheet("Projects per org")
 
         # print headers
-        ppo_sheet.write(f"A1", "Organization", bold_text)
-        ppo_sheet.write(f"B1", "#", bold_text)
+        workbook.write_row(ppo_sheet, 0, ["Organization", "#"], bold_text)
 
         # print the UNIQUE function to get all org names
         ppo_sheet.write(f'Y1', "Raw unsorted data for the plot, don't touch.")
         ppo_sheet.write(f"Y2", "=UNIQUE('Project list'!$E$2:'Project list'!$E$10000)") # how to get rid of the 0 0 ?
 
+        # create a sorted range for the pie chart, before moving on from row 2 since the rows are written in order
+        ppo_sheet.write('A2', f"=SORT(Y2:Z10000, 2)") # how to get rid of the spill over range filled with 0?
+
         # print the counting function
         for row_num in range(2,200):
 
             # for each row, print the number of occurences in the project list of the corresponding organization name, only if there is a org name on the current row
             ppo_sheet.write(f"Z{row_num}", f"=IF( ISBLANK(Y{row_num}), \"\", COUNTIF('Project list'!$E$2:'Project list'!$E$1000, Y{row_num}))")
 
-
-        # create a sorted range for the pie chart
-        ppo_sheet.write('A2', f"=SORT(Y2:Z10000, 2)") # how to get rid of the spill over range filled with 0?
-
         # create pie chart
         ppo_chart = workbook.add_chart({'type': 'pie'})
 
@@ -857,13 +992,17 @@ def check_required_args(args):
     Makes sure that we have enough info to generate a report.
     """
 
-    # check if at least one of --sll and --vr is set
-    if not (args.sll or args.vr):
-        sys.exit("ERROR: At least one of --sll or --vr must be specified.")
+    # check if at least one of --sll and --vr is set, --annual writes all reports
+    if not (args.sll or args.vr or args.annual):
+        sys.exit("ERROR: At least one of --sll, --vr or --annual must be specified.")
 
-    # check if either --long-term, --sm-term or project-[id, name] is set.
-    if not (args.long_term or args.sm_term or args.project_id or args.project_name or args.biif):
-        sys.exit("ERROR: No project(s) selected, either --long-term, --sm-term, --biif, --project-id or --project-name must be set.")
+    # check if either --long-term, --sm-term, --biif or --project-id is set, --annual selects the projects itself.
+    if not (args.long_term or args.sm_term or args.project_id or args.biif or args.annual):
+        sys.exit("ERROR: No project(s) selected, either --long-term, --sm-term, --biif, --project-id or --annual must be set.")
+
+    # --annual splits the time entries by term itself
+    if args.annual and (args.long_term or args.sm_term or args.project_id or args.biif):
+        sys.exit("ERROR: --annual can not be combined with --long-term, --sm-term, --biif or --project-id.")
 
     # check that some timeframe is set
     if not (args.year or (args.start_date and args.end_date)):
@@ -875,6 +1014,10 @@ def resolve_args(args):
     Resolves the shortcut arguments (e.g. --dm, --long-term) to the actual arguments.
     """
 
+    # split the comma separated lists given on the command line
+    args.project_id      = args.project_id.split(',')      if args.project_id      else []
+    args.activity_filter = args.activity_filter.split(',') if args.activity_filter else []
+
     # resolve --sm-term
     if args.sm_term:
 
@@ -918,7 +1061,7 @@ def resolve_args(args):
     # resolve --dm
     if args.dm:
 
-        dm_activity_filter_text = "[DM]"
+        dm_activity_filter_text = "(DM)"
         logging.info(f'--dm specified, adding "{dm_activity_filter_text}" to --activity-filter list.')
 
         try:
@@ -943,145 +1086,114 @@ def resolve_args(args):
 
 
 
-def get_redmine_project_structure(config):
+def resolve_project_ids(args, redmine):
     """
-    Build a dict with the strucutre of the Redmine projects, and a name-id translation table.
+    Converts the names/ids/identifiers given in --project-id to Redmine project ids.
     """
 
-    params = {
-        'key': config['api_key'],
-        'limit': 100,
-        'offset': 0
-    }
-
-    # get the project list
-    redmine_projects = []
-    
-    response = requests.get(f"{config['url']}/projects.json", params=params)
-    response.raise_for_status()
-    data = response.json()
-
-    redmine_projects.extend(data['projects'])
-
-    total_count = data['total_count']
-    while params['offset'] < total_count:
-        response = requests.get(f"{config['url']}/projects.json", params=params)
-        response.raise_for_status()
-        data = response.json()
+    # init
+    project_ids = []
 
+    # convert all text names to project id#
+    for name in args.project_id:
 
-        redmine_projects.extend(data['projects'])
+        project_id = redmine.resolve_project_id(name)
 
-        params['offset'] += params['limit']
+        # it didn't match any project
+        if project_id is None:
 
-        # Calculate progress percentage
-        progress = min(params['offset'], total_count) / total_count * 100
-        print(f'Fetching Redmine project: {progress:.2f}% complete                ', end='\r')
+            if args.force:
+                logging.warn(f'Project identifier found no match among all Redmine projects: "{name}"')
+            else:
+                #pdb.set_trace()
+                logging.error(f'Project identifier found no match among all Redmine projects: "{name}"')
+                sys.exit(-1)
 
-    print('Fetching Redmine projects: 100% complete                             ')
+        # add the project id to the list
+        elif project_id not in project_ids:
+            project_ids.append(project_id)
 
-    # Initialize an empty dictionary to store the hierarchy
-    projects_dict = {}
+    return project_ids
 
-    # restructure projects at a dict
-    redmine_projects = { proj['id']:proj for proj in redmine_projects }
 
-    redmine_projects['utils']                    = {}
-    redmine_projects['utils']['name2id']         = {}
-    redmine_projects['utils']['id2name']         = {}
-    redmine_projects['utils']['name2identifier'] = {}
-    redmine_projects['utils']['identifier2name'] = {}
-    redmine_projects['utils']['id2identifier']   = {}
-    redmine_projects['utils']['identifier2id']   = {}
+def create_project_filter_list(args, redmine, project_ids):
+    """
+    Creates a list of project ids we want to filter on. Based on --project-id and --recursive.
+    """
 
+    # add all children if any as well if recursive is set
+    project_id_filter_list, _ = redmine.resolve_projects(project_ids, recursive=args.recursive)
 
-    # Function to recursively build the dictionary
-    def build_project_hierarchy(project, child_ids):
-        
-        # add name conversions to translation tables
-        redmine_projects['utils']['name2id'][project['name']]               = project['id']
-        redmine_projects['utils']['id2name'][project['id']]                 = project['name']
-        redmine_projects['utils']['name2identifier'][project['name']]       = project['identifier']
-        redmine_projects['utils']['identifier2name'][project['identifier']] = project['name']
-        redmine_projects['utils']['id2identifier'][project['id']]           = project['identifier']
-        redmine_projects['utils']['identifier2id'][project['identifier']]   = project['id']
-
-        # if there are any children to be added
-        if len(child_ids) > 0:
-            try:
-                redmine_projects[project['id']]['children'].update(child_ids)
-            except:
-                redmine_projects[project['id']]['children'] = set()
-                redmine_projects[project['id']]['children'].update(child_ids)
+    return project_id_filter_list
 
-        # if we have reached the top
-        if 'parent' not in project:
-            return
 
-        # add this project and its children to the list of children
-        child_ids.add(project['id'])
-        child_ids.update(redmine_projects[project['id']].get('children', set()))
+def output_path(path, *parts):
+    """
+    Adds the parts to the file name of path, e.g. (report.xlsx, 'sll', 'sm-term') -> report_sll_sm-term.xlsx
+    """
 
-        # pass on the child list to the parent
-        build_project_hierarchy(redmine_projects[project['parent']['id']], child_ids=child_ids)
+    stem, ext = os.path.splitext(path)
+    return '_'.join([stem, *parts]) + (ext or '.xlsx')
 
 
-    # process each project
-    for key,project in redmine_projects.items():
 
-        # skip utility key
-        if key == 'utils':
-            continue
+def generate_annual_reports(args, raw_args, redmine):
+    """
+    Writes the SciLifeLab and VR reports for both the short-medium and long term projects, and Bengt's report,
+    from a single fetch of the time entries and issues.
 
-        build_project_hierarchy(project, child_ids=set())
+    Args:
+        args (Namespace): Resolved arguments.
+        raw_args (Namespace): The arguments as given on the command line, to resolve once per term.
+        redmine (Redmine_utils): Redmine connection and project structure.
+    """
 
+    session = redmine.session
 
+    # all reports are written unless only some were asked for
+    reports = [ report for report in ('sll', 'vr') if getattr(args, report) ] or ['sll', 'vr']
 
+    # fetch all time entries in the period once, they are split by term in memory
+    time_entries = get_all_time_entries(args, session)
 
-    return redmine_projects
 
+    # resolve the projects and summarize the time entries of each term
+    terms = {}
+    for term in ('sm-term', 'long-term'):
 
-def create_project_filter_list(args, redmine_projects):
-    """
-    Creates a list of project ids we want to filter on. Based on --project-id and --recursive.
-    """
+        term_args = argparse.Namespace(**vars(raw_args))
+        term_args.sm_term   = term == 'sm-term'
+        term_args.long_term = term == 'long-term'
+        term_args           = resolve_args(term_args)
 
-    # init
-    project_id_filter_list = set()
+        project_ids    = resolve_project_ids(term_args, redmine)
+        project_filter = create_project_filter_list(term_args, redmine, project_ids)
+        issue_ids      = aggregate_time_entries(term_args, time_entries, project_filter=set(project_filter))
 
-    # convert all text names to project id#
-    for name in args.project_id:
+        terms[term] = (term_args, project_filter, issue_ids)
 
-        match_found = False
 
-        # for all redmine projects
-        for project in redmine_projects.values():
+    # fetch the issues of all terms at once
+    fetched_issues = fetch_issues({ issue_id for _, _, issue_ids in terms.values() for issue_id in issue_ids }, session)
 
-            # check if the name matches the id, name or identifier
-            if str(name) == str(project['id']) or name == project['identifier'] or name == project['name']:
+    for term, (term_args, project_filter, issue_ids) in terms.items():
 
-                # add the project id to the filter lsit
-                project_id_filter_list.add(project['id'])
+        issue_details = fetch_issue_details(issue_ids, session, project_filter, fetched_issues)
 
-                # if recursive is set, add all children if any as well
-                if args.recursive:
-                    project_id_filter_list.update(project.get('children', []))
+        # if sll
+        if 'sll' in reports:
+            generate_sll_report(issue_details, term_args.project_id, term_args.start_date, term_args.end_date, output_path(args.output, 'sll', term))
 
-                # jump to next name
-                match_found = True
-                break
+        # if vr
+        if 'vr' in reports:
+            generate_vr_report(term_args, issue_details, output_path(args.output, 'vr', term))
 
-        # it didn't match any project
-        if not match_found:
 
-            if args.force:
-                logging.warn(f'Project identifier found no match among all Redmine projects: "{name}"')
-            else:
-                #pdb.set_trace()
-                logging.error(f'Project identifier found no match among all Redmine projects: "{name}"')
-                sys.exit(-1)
+    # Bengt's report is made from the same time entries, for all users
+    users = generate_bengts_report.get_users(session, None)
+    spent_time_data, percent_matrix_data = generate_bengts_report.summarize_time_entries(time_entries, users, redmine, redmine.projects)
+    generate_bengts_report.generate_report(spent_time_data, percent_matrix_data, argparse.Namespace(output=output_path(args.output, 'bengt')), redmine)
 
-    return project_id_filter_list
 
 
 def main():
@@ -1103,6 +1215,9 @@ python3 generate_report.py -c config.yaml --vr  --sm-term   --year 2023 -o sll_2
 
 # standard VR report for long term projects 2023
 python3 generate_report.py -c config.yaml --vr  --long-term --year 2023 -o sll_2023.xlsx
+
+# all of the above and Bengt's report, from a single fetch (writes report_2023_sll_sm-term.xlsx, report_2023_vr_long-term.xlsx, report_2023_bengt.xlsx etc)
+python3 generate_report.py -c config.yaml --annual --year 2023 -o report_2023.xlsx
 """, formatter_class=RawTextHelpFormatter)
 
     required_files_group = parser.add_argument_group('Required files')
@@ -1110,12 +1225,14 @@ python3 generate_report.py -c config.yaml --vr  --long-term --year 2023 -o sll_2
     required_files_group.add_argument('-o', '--output',     help='Output file path', required=True,)
 
     shortcuts_group = parser.add_argument_group('Shortcut options')
-    shortcuts_group.add_argument('--dm',                    help='Use to only consider time logged in an activity with "[DM]" in its name.', action='store_true')
+    shortcuts_group.add_argument('--dm',                    help='Use to only consider time logged in an activity with "(DM)" in its name.', action='store_true')
     shortcuts_group.add_argument('--long-term',             help='Use to only include project in and under the "Long-term Support" project.', action='store_true')
     shortcuts_group.add_argument('--sm-term',               help='Use to only include project in and under the "National Bioinformatics Support" project.', action='store_true')
     shortcuts_group.add_argument('--biif',                  help='Use to only include project in and under the "Bioimage Informatics" project.', action='store_true')
     shortcuts_group.add_argument('--sll',                   help='Use to include the SciLifeLab report specific statistics in the output file.',      action='store_true')
     shortcuts_group.add_argument('--vr',                    help='Use to include the Vetenskapsrådet report specific statistics in the output file.', action='store_true')
+    shortcuts_group.add_argument('--static-stats',          help='Use to count the projects per organization, sex, SCB subject code and tracker in the VR report when it is generated, instead of with Excel formulas.', action='store_true')
+    shortcuts_group.add_argument('--annual',                help='Use to write the SciLifeLab and VR reports for both short-medium and long term projects, and Bengt\'s report, from a single fetch.', action='store_true')
     shortcuts_group.add_argument('-y', '--year',            help='Shortcut to select start and end date as $(YEAR-1)-dec to $YEAR-dec'         , type=int)
 
     filters_group = parser.add_argument_group('Filter options')
@@ -1126,6 +1243,8 @@ python3 generate_report.py -c config.yaml --vr  --long-term --year 2023 -o sll_2
     filters_group.add_argument('-f', '--force',             help='Use to continue generating the report even if there are warnings.', action='store_true')
     filters_group.add_argument('-r', '--recursive',         help='Use together with --project-id or --project-name to recursivly include all subprojects to the project specified.', action='store_true')
 
+    add_cache_arguments(parser.add_argument_group('Cache options'))
+
     global args
     args = parser.parse_args()
 
@@ -1137,31 +1256,47 @@ python3 generate_report.py -c config.yaml --vr  --long-term --year 2023 -o sll_2
     global config
     with open(args.config) as f:
         config = yaml.safe_load(f)
+    config.update(refresh=args.refresh, offline=args.offline, store=args.store)
 
-    # resolve the arguments
-    args = resolve_args(args)
+    # resolve the arguments, keeping the unresolved ones for --annual
+    raw_args = argparse.Namespace(**vars(args))
+    args     = resolve_args(args)
 
     # construct the project hierarchy
     redmine = Redmine_utils(config)
-    redmine_projects = get_redmine_project_structure(config)
+    redmine_projects = redmine.projects
+
+    # write all annual reports from a single fetch
+    if args.annual:
+        generate_annual_reports(args, raw_args, redmine)
+        return
 
 
     # generate list of projects to filiter out
-    project_id_filter_list = create_project_filter_list(args, redmine_projects)
+    project_ids            = resolve_project_ids(args, redmine)
+    project_id_filter_list = create_project_filter_list(args, redmine, project_ids)
+
+    # get the ids of the activities to include
+    activity_ids = resolve_activity_filter(args, redmine)
 
     #pdb.set_trace()
 
-    issue_ids       = fetch_time_entries(args, config['url'], config['api_key'])
-    issue_details   = fetch_issue_details(issue_ids, config['url'], config['api_key'], project_id_filter_list)
+    session         = redmine.session
+    issue_ids, fetched_issues = fetch_time_entries(args, session, project_ids, redmine_projects, activity_ids)
+    issue_details             = fetch_issue_details(issue_ids, session, project_id_filter_list, fetched_issues)
     #statistics      = generate_statistics(issue_details)
 
+    # write each report to its own file if both are requested
+    sll_output = output_path(args.output, 'sll') if args.sll and args.vr else args.output
+    vr_output  = output_path(args.output, 'vr')  if args.sll and args.vr else args.output
+
     # if sll
     if args.sll:
-        generate_sll_report(issue_details, args.project_id, args.start_date, args.end_date,  args.output)
+        generate_sll_report(issue_details, args.project_id, args.start_date, args.end_date,  sll_output)
 
     # if vr
     if args.vr:
-        generate_vr_report(args, issue_details, args.output)
+        generate_vr_report(args, issue_details, vr_output)
 
 if __name__ == '__main__':
     main()
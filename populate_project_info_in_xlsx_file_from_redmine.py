@@ -1,66 +1,86 @@
 import argparse
-import requests
+import os
+import shutil
+import tempfile
 import yaml
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
 import pdb
+import requests
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
+from Redmine_utils import get_session, add_cache_arguments, Issue, get_custom_field
 
 
+def fetch_redmine_users(session, user_ids):
+    # Fetch only the given users from the Redmine API, in parallel, or from the local cache if they are up to date
+    def fetch_user(user_id):
+        try:
+            user = session.get_metadata(f"users/{user_id}", f"users/{user_id}.json")["user"]
+        except requests.RequestException:
+            # deleted or locked users can't be fetched, leave them out
+            return None
+        return user["firstname"] + " " + user["lastname"]
 
+    user_ids = list(user_ids)
+    with ThreadPoolExecutor(max_workers=session.workers) as executor:
+        user_names = executor.map(fetch_user, user_ids)
 
-def get_custom_field(issue, field_name):
-    """ Get custom field value from issue """
+    return { user_id: user_name for user_id, user_name in zip(user_ids, user_names) if user_name is not None }
 
-    # get field value
-    field_value = [ field['value'] for field in issue['custom_fields'] if field['name']==field_name ]
-    if len(field_value) > 0:
-        field_value = field_value[0]
+def fetch_redmine_ticket(session, ticket_id):
+    # Make a request to the Redmine API to fetch the ticket information
+    response = session.get(f"{session.url}/issues/{ticket_id}.json")
+    if response.status_code == 200:
+        return Issue(response.json()["issue"])
     else:
-        field_value = ''
-
-    return field_value
-
-def fetch_redmine_users(redmine_url, api_key):
-    # Make a request to the Redmine API to fetch all users
-    users = {}
-    offset = 0
-    limit = 100
-    total_count = float('inf')
-
-    headers = {"X-Redmine-API-Key": api_key}
-
-    while offset < total_count:
-        params = {"offset": offset, "limit": limit}
-        response = requests.get(f"{redmine_url}/users.json", headers=headers, params=params)
+        return None
 
-        if response.status_code == 200:
-            data = response.json()
-            total_count = data["total_count"]
+def fetch_redmine_tickets(session, ticket_ids):
+    # Fetch the tickets in batches of ids, closed ones included, with the batches fetched in parallel
+    ticket_ids = list(ticket_ids)
+    tickets = {}
+    for issues in session.get_issues(ticket_ids):
+        for issue in issues:
+            tickets[issue["id"]] = Issue(issue)
+
+    # tickets the issue list doesn't show, e.g. in archived projects, are tried one by one as before
+    missing_ids = [ ticket_id for ticket_id in ticket_ids if ticket_id not in tickets ]
+    with ThreadPoolExecutor(max_workers=session.workers) as executor:
+        for ticket_id, ticket in zip(missing_ids, executor.map(lambda ticket_id: fetch_redmine_ticket(session, ticket_id), missing_ids)):
+            if ticket:
+                tickets[ticket_id] = ticket
+
+    return tickets
+
+def get_coordinator_id(ticket):
+    # The Coordinator custom field holds a user id, or is empty
+    try:
+        return int(get_custom_field(ticket, 'Coordinator'))
+    except (TypeError, ValueError):
+        return None
 
-            for user in data["users"]:
-                user_id = user["id"]
-                user_name = user["firstname"] + " " + user["lastname"]
-                users[user_id] = user_name
+def fetch_new_columns(session, project_ids):
+    # Fetch the Redmine ticket of each unique project ID at once, and return the values of the new columns by project ID
+    project_ids = list(dict.fromkeys(project_ids))
+    print(f"Fetching Redmine tickets for {len(project_ids)} project IDs...")
+    tickets = fetch_redmine_tickets(session, project_ids)
 
-            offset += limit
-        else:
-            break
+    # Fetch only the users that are coordinators of the tickets
+    coordinator_ids = { get_coordinator_id(ticket) for ticket in tickets.values() } - {None}
+    redmine_users = fetch_redmine_users(session, coordinator_ids)
 
-    return users
+    # Assignee, Coordinator and Project Name
+    return { project_id: [ticket.assigned_to, redmine_users.get(get_coordinator_id(ticket), ""), ticket.subject] for project_id, ticket in tickets.items() }
 
-def fetch_redmine_ticket(redmine_url, api_key, ticket_id):
-    # Make a request to the Redmine API to fetch the ticket information
-    headers = {"X-Redmine-API-Key": api_key}
-    response = requests.get(f"{redmine_url}/issues/{ticket_id}.json", headers=headers)
-    if response.status_code == 200:
-        return response.json()["issue"]
-    else:
+def to_project_id(value):
+    # Return the project ID of a cell value, or None if it can't be converted to an integer
+    try:
+        return int(value)
+    except (TypeError, ValueError):
         return None
 
-def populate_xlsx_file(redmine_url, api_key, xlsx_file_path):
-
-    # Fetch all users from the Redmine API
-    redmine_users = fetch_redmine_users(redmine_url, api_key)
+def populate_xlsx_file(session, xlsx_file_path):
 
     # Open the existing xlsx file
     workbook = openpyxl.load_workbook(xlsx_file_path)
@@ -88,61 +108,127 @@ def populate_xlsx_file(redmine_url, api_key, xlsx_file_path):
     for col in range(3, 6):
         worksheet.cell(row=2, column=col).font = header_format
 
-    # Iterate through each row in the column with "Project ID"
+    # Collect the project ID of each row, skipping the ones that can't be converted to an integer
+    row_project_ids = {}
     for row in range(3, worksheet.max_row + 1):
-        project_id = worksheet.cell(row=row, column=project_id_column).value
-
-        # Check if project_id can be converted to an integer
-        try:
-            project_id = int(project_id)
-        except (TypeError, ValueError):
-            continue
-
-        print(f"Fetching Redmine ticket for project ID {project_id}...")
+        project_id = to_project_id(worksheet.cell(row=row, column=project_id_column).value)
+        if project_id is not None:
+            row_project_ids[row] = project_id
 
-        # Fetch the Redmine ticket information
-        ticket = fetch_redmine_ticket(redmine_url, api_key, project_id)
+    new_columns = fetch_new_columns(session, row_project_ids.values())
 
-        if ticket:
-
-            # Get the coordinator name
-            coordinator_id = get_custom_field(ticket, 'Coordinator')
-            try:
-                coordinator = redmine_users[int(coordinator_id)]
-            except (KeyError, ValueError):
-                coordinator = ""
+    # Fill in the rows from the fetched tickets
+    for row, project_id in row_project_ids.items():
+        if project_id in new_columns:
 
             # Write the ticket information to the new columns
-            try:
-                worksheet.cell(row=row, column=3, value=ticket["assigned_to"]["name"])
-            except KeyError:
-                worksheet.cell(row=row, column=3, value="")
-            worksheet.cell(row=row, column=4, value=coordinator)
-            worksheet.cell(row=row, column=5, value=ticket["subject"])
-
-            # Shift the existing columns to the right
-#            for col in range(worksheet.max_column, 3, -1):
-#                worksheet.cell(row=row, column=col).value = worksheet.cell(row=row, column=col - 2).value
+            for col, value in enumerate(new_columns[project_id], 3):
+                worksheet.cell(row=row, column=col, value=value)
 
     # Save the modified xlsx file
     workbook.save(xlsx_file_path)
 
+def copy_cell(worksheet, cell):
+    # Make a write-only copy of a read-only cell, keeping its formatting
+    new_cell = WriteOnlyCell(worksheet, value=cell.value)
+    if getattr(cell, "has_style", False):
+        new_cell.font = cell.font
+        new_cell.fill = cell.fill
+        new_cell.border = cell.border
+        new_cell.alignment = cell.alignment
+        new_cell.number_format = cell.number_format
+        new_cell.protection = cell.protection
+    return new_cell
+
+def populate_xlsx_file_streaming(session, xlsx_file_path):
+    # Same as populate_xlsx_file, but the file is read and written row by row,
+    # so that the memory used doesn't grow with the size of the sheet.
+    # Column widths, row heights and merged cells are not kept, as they can't be read in read-only mode.
+    workbook = openpyxl.load_workbook(xlsx_file_path, read_only=True)
+    try:
+        worksheet = workbook["Projects Active"]
+
+        # Find the column index for "Project ID" in the header row
+        header = next(worksheet.iter_rows(min_row=2, max_row=2, values_only=True), ())
+        project_id_index = header.index("Project ID")
+
+        # Collect the project IDs in a first pass, skipping the ones that can't be converted to an integer
+        project_ids = []
+        for (project_id,) in worksheet.iter_rows(min_row=3, min_col=project_id_index + 1, max_col=project_id_index + 1, values_only=True):
+            project_id = to_project_id(project_id)
+            if project_id is not None:
+                project_ids.append(project_id)
+
+        new_columns = fetch_new_columns(session, project_ids)
+
+        # Write a new workbook next to the old one, and replace the old one with it when it is done
+        new_workbook = openpyxl.Workbook(write_only=True)
+        for sheet in workbook.worksheets:
+            new_sheet = new_workbook.create_sheet(sheet.title)
+
+            for row_num, row in enumerate(sheet.iter_rows(), 1):
+                cells = [ copy_cell(new_sheet, cell) for cell in row ]
+
+                # Splice in the three new columns before column C, like insert_cols(3, 3)
+                if sheet.title == "Projects Active":
+                    while len(cells) < 2:
+                        cells.append(None)
+
+                    if row_num == 2:
+                        # use the formatting of the "Project ID" header for the new column names
+                        header_font = row[project_id_index].font
+                        values = ["Assignee", "Coordinator", "Project Name"]
+                    else:
+                        header_font = None
+                        project_id = to_project_id(row[project_id_index].value) if row_num > 2 and project_id_index < len(row) else None
+                        values = new_columns.get(project_id, [None, None, None])
+
+                    new_cells = []
+                    for value in values:
+                        new_cell = WriteOnlyCell(new_sheet, value=value)
+                        if header_font is not None:
+                            new_cell.font = header_font
+                        new_cells.append(new_cell)
+                    cells[2:2] = new_cells
+
+                new_sheet.append(cells)
+
+        output_file, output_path = tempfile.mkstemp(suffix=".xlsx", dir=os.path.dirname(os.path.abspath(xlsx_file_path)))
+        os.close(output_file)
+        try:
+            new_workbook.save(output_path)
+
+            # mkstemp makes the file readable by the owner only, keep the permissions of the workbook
+            shutil.copymode(xlsx_file_path, output_path)
+            os.replace(output_path, xlsx_file_path)
+        except BaseException:
+            os.remove(output_path)
+            raise
+    finally:
+        workbook.close()
+
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="Populate an xlsx file with data from the Redmine API")
     parser.add_argument("redmine_credentials", help="Path to the YAML file containing Redmine API key")
     parser.add_argument("xlsx_file_path", help="Path to the xlsx file")
+    parser.add_argument("--streaming", action="store_true", help="Read and write the xlsx file row by row, using little memory on large sheets. Column widths, row heights and merged cells are not kept.")
+    add_cache_arguments(parser, time_entries=False)
     args = parser.parse_args()
 
     # Read the Redmine URL and API key from the YAML file
     with open(args.redmine_credentials, "r") as file:
         config = yaml.safe_load(file)
+    config.update(refresh=args.refresh, offline=args.offline)
 
-    redmine_url = config["url"]
-    api_key = config["api_key"]
+    # Connect to Redmine through the shared session
+    session = get_session(config)
 
     # Populate the xlsx file with data from the Redmine API
-    populate_xlsx_file(redmine_url, api_key, args.xlsx_file_path)
+    if args.streaming:
+        populate_xlsx_file_streaming(session, args.xlsx_file_path)
+    else:
+        populate_xlsx_file(session, args.xlsx_file_path)
 
 if __name__ == "__main__":
     main()
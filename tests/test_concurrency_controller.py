@@ -0,0 +1,61 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Redmine_utils import Concurrency_controller
+
+
+
+def replay(controller, answers):
+    """
+    Send (key, latency) answers through the controller one at a time, and return the limit after each.
+    """
+
+    limits = []
+    for key, latency in answers:
+        assert controller.try_acquire()
+        controller.release(latency, False, key)
+        limits.append(controller.limit)
+
+    return limits
+
+
+
+def test_fast_probes_do_not_throttle_slow_pages():
+    # a few quick limit=1 probes, then the usual slower pages of time entries
+    controller = Concurrency_controller(8)
+    limits     = replay(controller, [('probe', 0.05)] * 4 + [('page', 0.6)] * 600)
+
+    assert min(limits) == 8
+
+
+
+def test_mixed_fast_and_slow_answers_keep_the_limit():
+    controller = Concurrency_controller(8)
+    limits     = replay(controller, [('probe', 0.05), ('page', 0.6)] * 300)
+
+    assert min(limits) == 8
+
+
+
+def test_limit_recovers_after_a_slowdown():
+    controller = Concurrency_controller(8)
+
+    # the pages get much slower, the limit goes down but not below min_limit
+    limits = replay(controller, [('page', 0.4)] * 50 + [('probe', 0.05), ('page', 2.0)] * 50)
+    assert limits[-1] < 8
+    assert min(limits) >= controller.min_limit
+
+    # and back to normal, the limit grows back
+    limits = replay(controller, [('probe', 0.05), ('page', 0.4)] * 200)
+    assert limits[-1] == 8
+
+
+
+def test_overload_halves_the_limit():
+    controller = Concurrency_controller(8)
+    assert controller.try_acquire()
+    controller.release(None, True, 'page')
+
+    assert controller.limit == 4